@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 # std
+import logging
 from typing import Any, Callable, Coroutine
 
 # packages
@@ -11,12 +12,17 @@ import traceback
 import infinitode
 from discord.ext import commands, tasks
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import PyMongoError
 
 # local
 import config
 from common import custom, errors
+from common.api import CachedSession
+from common.schema import ensure_schema
 from common.utils import codeblock
 
+log = logging.getLogger(__name__)
+
 # exts to load
 exts = [
     "account",
@@ -63,7 +69,7 @@ class Advinas(commands.Bot):
     async def start(self, token: str, *, reconnect: bool = True):
         # this is simply to make sure the session gets closed after the bot shuts down
         async with aiohttp.ClientSession(loop=self.loop) as self.session:
-            async with infinitode.Session(session=self.session) as self.API:  # epic
+            async with CachedSession(session=self.session) as self.API:  # epic
                 await super().start(token, reconnect=reconnect)
 
     async def setup_hook(self):
@@ -81,6 +87,11 @@ class Advinas(commands.Bot):
         self.BOT_CHANNELS: list[int] = config.bot_channels
         self.LEVELS: list[str]
         self.DB = AsyncIOMotorClient(config.mongo).inf2
+        try:
+            await ensure_schema(self.DB)
+        except PyMongoError:
+            # the bot still works without the indexes, only slower
+            log.exception("Could not ensure the database schema")
         self.online_since = discord.utils.utcnow()
 
     async def get_context(
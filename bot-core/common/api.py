@@ -0,0 +1,137 @@
+from __future__ import annotations
+
+# std
+import copy
+import asyncio
+import inspect
+import datetime
+from functools import wraps
+from typing import Any, Callable, Coroutine
+
+# packages
+import aiohttp
+import infinitode
+
+# local
+from common.cache import TTLCache
+
+_MISSING: Any = object()
+
+
+def _signature(func: Callable[..., Any]) -> inspect.Signature:
+    # the library's cache decorator doesn't use functools.wraps, the original
+    # function with its real parameters is only reachable through its closure
+    inner = getattr(func, "__func__", func)
+    for cell in inner.__closure__ or ():
+        if inspect.iscoroutinefunction(cell.cell_contents):
+            return inspect.signature(cell.cell_contents)
+    return inspect.signature(inner)
+
+
+def _consume_exception(task: asyncio.Task[Any]) -> None:
+    # the callers awaiting the task may all have been cancelled
+    if not task.cancelled():
+        task.exception()
+
+
+class CachedSession(infinitode.Session):
+    """An infinitode Session that caches responses per endpoint.
+
+    Every endpoint listed in ``ttls`` gets its own LRU cache, so a burst of
+    requests for one endpoint can't evict the entries of another. Failed
+    requests are never cached. Concurrent identical requests are coalesced
+    into a single upstream request. Passing ``fresh=True`` skips the cached
+    response, the new one replaces it. Callers get shallow copies of the
+    responses, so setting attributes on them doesn't change the cached ones.
+    """
+
+    # seconds the responses of each endpoint stay cached
+    ttls: dict[str, float] = {
+        "leaderboards": 60,
+        "leaderboards_rank": 60,
+        "runtime_leaderboards": 300,
+        "skill_point_leaderboard": 120,
+        "daily_quest_leaderboards": 60,
+        "seasonal_leaderboard": 120,
+        "player": 30,
+        "search_players": 60,
+    }
+    # leaderboards of past days can't change anymore
+    past_ttl: float = 30 * 24 * 3600
+
+    def __init__(
+        self, session: aiohttp.ClientSession | None = None, *, maxsize: int = 256
+    ) -> None:
+        # the library's own cache is unbounded and also caches failed requests
+        super().__init__(session, cache_enabled=False)
+        self.caches: dict[str, TTLCache[tuple[Any, ...], Any]] = {}
+        self.coalesced: dict[str, int] = {name: 0 for name in self.ttls}
+        for name, ttl in self.ttls.items():
+            self.caches[name] = TTLCache(maxsize=maxsize, ttl=ttl)
+            setattr(self, name, self._cached(name, getattr(self, name)))
+
+    def _ttl(self, name: str, arguments: dict[str, Any]) -> float:
+        if name != "daily_quest_leaderboards":
+            return self.ttls[name]
+
+        date = arguments.get("date")
+        if isinstance(date, datetime.datetime):
+            date = date.date()
+        elif isinstance(date, str):
+            try:
+                date = datetime.datetime.strptime(date, "%Y-%m-%d").date()
+            except ValueError:
+                date = None
+
+        today = datetime.datetime.now(datetime.timezone.utc).date()
+        if isinstance(date, datetime.date) and date < today:
+            return self.past_ttl
+        return self.ttls[name]
+
+    def _cached(
+        self, name: str, func: Callable[..., Coroutine[Any, Any, Any]]
+    ) -> Callable[..., Coroutine[Any, Any, Any]]:
+        cache = self.caches[name]
+        inflight: dict[tuple[Any, ...], asyncio.Task[Any]] = {}
+        signature = _signature(func)
+
+        async def fetch(
+            key: tuple[Any, ...], arguments: dict[str, Any], *args: Any, **kwargs: Any
+        ) -> Any:
+            try:
+                value = await func(*args, **kwargs)
+                cache.set(key, value, self._ttl(name, arguments))
+                return value
+            finally:
+                del inflight[key]
+
+        @wraps(func)
+        async def wrapper(*args: Any, fresh: bool = False, **kwargs: Any) -> Any:
+            # the same call gives the same key, positional or not
+            bound = signature.bind(self, *args, **kwargs)
+            bound.apply_defaults()
+            arguments = dict(bound.arguments)
+            del arguments[next(iter(signature.parameters))]
+            key = tuple(sorted(arguments.items()))
+
+            value = cache.get(key, _MISSING) if not fresh else _MISSING
+            if value is not _MISSING:
+                return copy.copy(value)
+
+            # concurrent callers share one request instead of each sending their own
+            task = inflight.get(key)
+            if task is None:
+                task = asyncio.ensure_future(fetch(key, arguments, *args, **kwargs))
+                task.add_done_callback(_consume_exception)
+                inflight[key] = task
+            else:
+                self.coalesced[name] += 1
+
+            # shielded so a cancelled caller doesn't cancel it for everyone else
+            return copy.copy(await asyncio.shield(task))
+
+        return wrapper
+
+    def clear(self) -> None:
+        for cache in self.caches.values():
+            cache.clear()
@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+# std
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Generic, Hashable, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class TTLCache(Generic[K, V]):
+    """LRU cache whose entries expire ``ttl`` seconds after being set.
+
+    The cache holds at most ``maxsize`` entries and, if ``sizeof`` is given,
+    at most ``max_bytes`` worth of values. The least recently used entries
+    are evicted first once either limit is exceeded.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 128,
+        ttl: float = 300.0,
+        *,
+        max_bytes: int | None = None,
+        sizeof: Callable[[V], int] | None = None,
+    ) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = 0
+
+        self._data: OrderedDict[K, tuple[float, V, int]] = OrderedDict()
+
+    def get(self, key: K, default: Any = None) -> V | Any:
+        try:
+            expires, value, _ = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+        if expires < time.monotonic():
+            self.pop(key)
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def peek(self, key: K, default: Any = None) -> V | Any:
+        """Like get, but doesn't count towards the stats or the LRU order."""
+        try:
+            expires, value, _ = self._data[key]
+        except KeyError:
+            return default
+        return value if expires >= time.monotonic() else default
+
+    def set(self, key: K, value: V, ttl: float | None = None) -> None:
+        self.pop(key)
+
+        size = self.sizeof(value) if self.sizeof is not None else 0
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._data[key] = (expires, value, size)
+        self.size += size
+
+        while len(self._data) > self.maxsize or (
+            self.max_bytes is not None and self.size > self.max_bytes
+        ):
+            _, (_, _, evicted) = self._data.popitem(last=False)
+            self.size -= evicted
+            self.evictions += 1
+
+    def pop(self, key: K, default: Any = None) -> V | Any:
+        try:
+            _, value, size = self._data.pop(key)
+        except KeyError:
+            return default
+        self.size -= size
+        return value
+
+    def clear(self) -> None:
+        self._data.clear()
+        self.size = 0
+
+    def __contains__(self, key: K) -> bool:
+        try:
+            expires, _, _ = self._data[key]
+        except KeyError:
+            return False
+        return expires >= time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict[str, Any]:
+        total = self.hits + self.misses
+        stats: dict[str, Any] = {
+            "Entries": f"{len(self)}/{self.maxsize}",
+            "Hits": self.hits,
+            "Misses": self.misses,
+            "Hit rate": f"{self.hits / total:0.1%}" if total else "-",
+            "Evictions": self.evictions,
+        }
+        if self.max_bytes is not None:
+            stats["Size"] = f"{self.size / 2**20:0.1f}/{self.max_bytes / 2**20:0.1f}MiB"
+        return stats
@@ -260,7 +260,8 @@ class TagName(commands.clean_content):
 @dataclass
 class Tag:
     name: str
-    content: str
+    # None until loaded, guilds are cached without the content of their tags
+    content: str | None
     guild_id: int
     uses: int
     owner_id: int
@@ -269,15 +270,13 @@ class Tag:
     @classmethod
     def from_db(cls, payload: dict[str, Any]) -> Tag:
         """Creates a new Tag object with the given database payload."""
-        t: dict[str, Any] = payload["tags"][0]
-        guild = int(payload["guild"])
         return cls(
-            t["name"],
-            t["content"],
-            guild,
-            int(t["uses"]),
-            int(t["owner_id"]),
-            t["created_at"],
+            payload["name"],
+            payload.get("content"),
+            int(payload["guild"]),
+            int(payload["uses"]),
+            int(payload["owner_id"]),
+            payload["created_at"],
         )
 
     @classmethod
@@ -296,6 +295,10 @@ class TagAlias:
     @classmethod
     def from_db(cls, payload: dict[str, Any]) -> TagAlias:
         """Creates a new TagAlias object with the given database payload."""
-        t: dict[str, Any] = payload["tags"][0]
-        guild = int(payload["guild"])
-        return cls(t["name"], t["alias"], guild, int(t["owner_id"]), t["created_at"])
+        return cls(
+            payload["name"],
+            payload["alias"],
+            int(payload["guild"]),
+            int(payload["owner_id"]),
+            payload["created_at"],
+        )
@@ -61,6 +61,37 @@ class InvalidPlayerError(InCommandError):
         super().__init__(message)
 
 
+class APITimeoutError(InCommandError):
+    """Raised when the Infinitode API takes too long to respond."""
+
+    def __init__(
+        self,
+        message: str = "The Infinitode API took too long to respond, "
+        "try again later.",
+    ) -> None:
+        self.log: str = "API timed out."
+        super().__init__(message)
+
+
+class RendererBusyError(InCommandError):
+    """Raised when the profile renderer has too many pending renders."""
+
+    def __init__(self, retry_after: int) -> None:
+        self.log: str = "Renderer busy."
+        self.retry_after = retry_after
+        super().__init__(f"The renderer is busy, try again in {retry_after}s.")
+
+
+class RendererCrashedError(InCommandError):
+    """Raised when a render keeps crashing the renderer's worker processes."""
+
+    def __init__(
+        self, message: str = "Could not render this profile, try again later."
+    ) -> None:
+        self.log: str = "Renderer crashed."
+        super().__init__(message)
+
+
 class NoPlayerError(InCommandError):
     """Raised when the bot is not in a voice channel."""
 
@@ -1,35 +1,63 @@
 from __future__ import annotations
 
 # std
-import copy
 import os
+import time
+import hashlib
 from io import BytesIO
+from dataclasses import dataclass, field
 from datetime import datetime
+from typing import Any
 
 # packages
+from lru import LRU
 from PIL import Image, ImageDraw, ImageFont
 from infinitode import Player
 
 
+@dataclass(frozen=True)
+class _Draw:
+    """A single draw operation of a profile, equal keys draw equal pixels."""
+
+    key: tuple[Any, ...]
+    box: tuple[int, int, int, int]
+    image: Image.Image | None = field(default=None, compare=False)
+
+
 class Images:
+    # fmt: off
+    levels = (
+        '1.1', '1.2', '1.3', '1.4', '1.5', '1.6', '1.7', '1.8', '1.b1',
+        '2.1', '2.2', '2.3', '2.4', '2.5', '2.6', '2.7', '2.8', '2.b1',
+        '3.1', '3.2', '3.3', '3.4', '3.5', '3.6', '3.7', '3.8', '3.b1',
+        '4.1', '4.2', '4.3', '4.4', '4.5', '4.6', '4.7', '4.8', '4.b1',
+        '5.1', '5.2', '5.3', '5.4', '5.5', '5.6', '5.7', '5.8', '5.b1', '5.b2',
+        '6.1', '6.2', '6.3', '6.4', '6.5', 'rumble', 'dev', 'zecred',
+        'DQ1', 'DQ3', 'DQ4', 'DQ5', 'DQ7', 'DQ8', 'DQ9', 'DQ10', 'DQ11', 'DQ12',
+    )
+    # fmt: on
+
+    # output formats as name: (file extension, save options)
+    formats: dict[str, tuple[str, dict[str, Any]]] = {
+        "png": ("png", {"format": "png"}),
+        "png-fast": ("png", {"format": "png", "compress_level": 1}),
+        "png-palette": ("png", {"format": "png"}),
+        "webp": ("webp", {"format": "webp", "quality": 90, "method": 2}),
+        "jpeg": ("jpg", {"format": "jpeg", "quality": 90}),
+    }
+    lossless = ("png", "png-fast")
+
     def __init__(self) -> None:
-        # fmt: off
-        self.levels = (
-            '1.1', '1.2', '1.3', '1.4', '1.5', '1.6', '1.7', '1.8', '1.b1',
-            '2.1', '2.2', '2.3', '2.4', '2.5', '2.6', '2.7', '2.8', '2.b1',
-            '3.1', '3.2', '3.3', '3.4', '3.5', '3.6', '3.7', '3.8', '3.b1',
-            '4.1', '4.2', '4.3', '4.4', '4.5', '4.6', '4.7', '4.8', '4.b1',
-            '5.1', '5.2', '5.3', '5.4', '5.5', '5.6', '5.7', '5.8', '5.b1', '5.b2',
-            '6.1', '6.2', '6.3', '6.4', '6.5', 'rumble', 'dev', 'zecred',
-            'DQ1', 'DQ3', 'DQ4', 'DQ5', 'DQ7', 'DQ8', 'DQ9', 'DQ10', 'DQ11', 'DQ12',
-        )
-        # fmt: on
-        self.barrier_v = Image.open(
-            "assets/images/profile/teleporters/gate-barrier-type-vertical.png"
+        path = "assets/images/profile"
+        self.barrier_v = self._load(
+            f"{path}/teleporters/gate-barrier-type-vertical.png"
         )
-        self.barrier_h = Image.open(
-            "assets/images/profile/teleporters/gate-barrier-type-horizontal.png"
+        self.barrier_h = self._load(
+            f"{path}/teleporters/gate-barrier-type-horizontal.png"
         )
+        self.background = Image.open(f"{path}/default/default-dev.png")
+        self.background.load()
+        self.pfp_default = self._load(f"{path}/default/pfp-default.png")
         self.font_lvl = ImageFont.truetype(r"assets/fonts/default/Lato-Regular.ttf", 37)
         self.font_lvl_small = ImageFont.truetype(
             r"assets/fonts/default/Lato-Regular.ttf", 28
@@ -42,29 +70,49 @@ class Images:
         )
         self.font_rpl = ImageFont.truetype(r"assets/fonts/default/Lato-Regular.ttf", 48)
         self.small_fonts = ["rumble", "dev", "zecred"]
+        # measured text bounding boxes, keyed by (text, font, anchor)
+        self.text_boxes: LRU = LRU(4096)
 
         self.digits: dict[str, Image.Image] = {}
 
         for digit in range(0, 10):
-            self.digits[str(digit)] = Image.open(
-                f"assets/images/profile/levels/{digit}_digit.png"
-            )
+            self.digits[str(digit)] = self._load(f"{path}/levels/{digit}_digit.png")
 
         self.tp_h: dict[str, Image.Image] = {}
         self.tp_v: dict[str, Image.Image] = {}
-        path = "assets/images/profile/teleporters/"
 
-        for filename in os.listdir(path):
+        for filename in os.listdir(f"{path}/teleporters"):
             if filename.startswith("gate-teleport-vertical"):
                 colour = filename[25:-4]
                 if colour.startswith("-"):
                     colour = colour[1:]
-                self.tp_v[colour] = Image.open(path + filename)
+                self.tp_v[colour] = self._load(f"{path}/teleporters/{filename}")
             elif filename.startswith("gate-teleport-horizontal"):
                 colour = filename[27:-4]
                 if colour.startswith("-"):
                     colour = colour[1:]
-                self.tp_h[colour] = Image.open(path + filename)
+                self.tp_h[colour] = self._load(f"{path}/teleporters/{filename}")
+
+        # badges keyed by "{rarity}-{name}{extra}", e.g. "supreme-of-merit-1"
+        self.badges: dict[str, Image.Image] = {}
+        for filename in os.listdir(f"{path}/badges"):
+            if filename.startswith("pb-") and filename.endswith(".png"):
+                self.badges[filename[3:-4]] = self._load(f"{path}/badges/{filename}")
+
+        # season levels >= 150 are composited on first use, see _season_level_icon
+        self.season_levels: dict[int, Image.Image] = {}
+        self.profile_levels: dict[int, Image.Image] = {}
+        for filename in os.listdir(f"{path}/levels"):
+            level = filename[13:-4]
+            if filename.startswith("player-level-") and level.isdigit():
+                self.season_levels[int(level)] = self._load(f"{path}/levels/{filename}")
+        self.season_level_max = self._load(f"{path}/levels/player-level-max.png")
+        for filename in os.listdir(f"{path}/profile-levels"):
+            level = filename[14:-4]
+            if filename.startswith("profile-level-") and level.isdigit():
+                self.profile_levels[int(level)] = self._load(
+                    f"{path}/profile-levels/{filename}"
+                )
 
         # fmt: off
         self.default_tps: list[list[dict[int, str]]] = [
@@ -105,43 +153,182 @@ class Images:
         ]
         # fmt: on
 
-    def profile_gen(
-        self,
+        # teleporters are drawn on top of everything else, so the ones every
+        # profile has are composited into a single layer once
+        self.tp_layer = Image.new("RGBA", self.background.size)
+        for sprite, xy in self._teleporters(*self.default_tps):
+            self.tp_layer.alpha_composite(sprite, xy)
+
+        # barriers and teleporters that depend on the number of badges shown
+        self.layouts = {badge_c: self._layout(badge_c) for badge_c in range(5, 13)}
+
+    @staticmethod
+    def _load(fp: str) -> Image.Image:
+        return Image.open(fp).convert("RGBA")
+
+    def _teleporters(
+        self, tps_h: list[dict[int, str]], tps_v: list[dict[int, str]]
+    ) -> list[tuple[Image.Image, tuple[int, int]]]:
+        """Maps the teleporter grid to the sprites and their positions."""
+        sprites: list[tuple[Image.Image, tuple[int, int]]] = []
+        for g, row in enumerate(tps_h):
+            for h, colour in row.items():
+                sprites.append((self.tp_h[colour], (16 + 128 * (h - 1), 2 + 128 * g)))
+        for g, column in enumerate(tps_v):
+            for h, colour in column.items():
+                sprites.append((self.tp_v[colour], (2 + 128 * g, 16 + 128 * (h - 1))))
+        return sprites
+
+    def _layout(self, badge_c: int) -> tuple[
+        list[tuple[Image.Image, tuple[int, int]]],
+        list[tuple[Image.Image, tuple[int, int]]],
+    ]:
+        """Returns the barriers and extra teleporters for the given badge count."""
+        barriers: list[tuple[Image.Image, tuple[int, int]]] = []
+        tps_h: list[dict[int, str]] = [{} for _ in self.default_tps[0]]
+        tps_v: list[dict[int, str]] = [{} for _ in self.default_tps[1]]
+
+        for c, x in enumerate((642, 770, 898, 1026), start=6):
+            if badge_c >= c:
+                barriers.append((self.barrier_v, (x, 528)))
+
+        if badge_c > 9:
+            barriers.append((self.barrier_h, (1040, 514)))
+
+            if badge_c == 11:
+                barriers.append((self.barrier_h, (912, 514)))
+                barriers.append((self.barrier_v, (1026, 400)))
+                tps_v[7][4] = "teal"
+
+            else:
+                tps_h[4][8] = "teal"
+                tps_v[8][4] = "teal"
+
+        else:
+            tps_h[4][8] = "teal"
+            tps_h[4][9] = "teal"
+
+        return barriers, self._teleporters(tps_h, tps_v)
+
+    def _season_level_icon(self, season_level: int) -> Image.Image:
+        if season_level < 150 or season_level in self.season_levels:
+            return self.season_levels[season_level]
+
+        level = str(season_level)
+        lvl_ico = self.season_level_max.copy()
+        for index, digit in enumerate(level[:3]):
+            xy = 12 + 12 * index, 23
+            lvl_ico.paste(self.digits[digit], xy, self.digits[digit])
+        lvl_ico = lvl_ico.resize((100, 100))
+
+        self.season_levels[season_level] = lvl_ico
+        return lvl_ico
+
+    @staticmethod
+    def background_version(userid: int | None) -> int | None:
+        """The mtime of the user's custom background or None if they have none."""
+        try:
+            return os.stat(f"assets/images/profile/custom/{userid}.png").st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def avatar_digest(avatar_bytes: bytes | None) -> str | None:
+        return hashlib.blake2b(avatar_bytes).hexdigest() if avatar_bytes else None
+
+    @classmethod
+    def profile_key(
+        cls,
         player: Player,
         avatar_bytes: bytes | None = None,
         userid: int | None = None,
-    ) -> BytesIO:
-        """Generates the profile image for the profile command"""
+    ) -> str:
+        """Hashes everything profile_gen reads, equal keys render equal images."""
+        mtime = cls.background_version(userid)
+
+        scores = [player.score(level) for level in cls.levels]
+        extra = [player.daily_quest, player.skill_point]
+        fields = (
+            player.playerid,
+            player.nickname,
+            player.total_score,
+            player.total_rank,
+            player.created_at,
+            player.replays,
+            player.issues,
+            [(s.score, s.rank) for s in scores],
+            [(s.score, s.rank) if s is not None else None for s in extra],
+            sorted((name, tuple(value)) for name, value in player.badges.items()),
+            (player.season_level, player.season_xp, player.season_xp_max),
+            (player.level, player.xp, player.xp_max),
+            cls.avatar_digest(avatar_bytes),
+            (userid, mtime) if mtime is not None else None,
+        )
+        return hashlib.blake2b(repr(fields).encode(), digest_size=16).hexdigest()
+
+    def _text(self, xy: tuple[int, int], text: str, font: str, anchor: str) -> _Draw:
         try:
-            bg = Image.open(f"assets/images/profile/custom/{userid}.png")
-        except FileNotFoundError:
-            bg = Image.open("assets/images/profile/default/default-dev.png")
+            left, top, right, bottom = self.text_boxes[text, font, anchor]
+        except KeyError:
+            bbox = getattr(self, font).getbbox(text, anchor=anchor)
+            left, top, right, bottom = self.text_boxes[text, font, anchor] = bbox
+        x, y = xy
+        box = x + left - 2, y + top - 2, x + right + 2, y + bottom + 2
+        return _Draw(("text", xy, text, font, anchor), box)
+
+    @staticmethod
+    def _paste(
+        name: str, image: Image.Image, xy: tuple[int, int], masked: bool = True
+    ) -> _Draw:
+        x, y = xy
+        box = x, y, x + image.width, y + image.height
+        return _Draw(("paste", name, xy, masked), box, image)
+
+    @staticmethod
+    def _rectangle(box: tuple[int, int, int, int], fill: str) -> _Draw:
+        x0, y0, x1, y1 = box
+        return _Draw(("rectangle", box, fill), (x0, y0, x1 + 1, y1 + 1))
+
+    def _profile_draws(
+        self,
+        player: Player,
+        avatar_bytes: bytes | None = None,
+        avatar_digest: str | None = None,
+    ) -> list[_Draw]:
+        """Lists everything drawn onto the background, in drawing order.
 
-        badge_keys = list(player.badges.keys())
-        badge_values = list(player.badges.values())
-        default_tps_h = copy.deepcopy(self.default_tps[0])
-        default_tps_v = copy.deepcopy(self.default_tps[1])
+        Without avatar_bytes, an avatar_digest only yields the key and box of
+        the avatar, enough to diff against but not to paint.
+        """
+        draws: list[_Draw] = []
 
         if avatar_bytes:
+            digest = self.avatar_digest(avatar_bytes)
             pfp = Image.open(BytesIO(avatar_bytes)).resize((512, 512))
+            draws.append(self._paste(f"avatar-{digest}", pfp, (16, 16), False))
+        elif avatar_digest is not None:
+            key = ("paste", f"avatar-{avatar_digest}", (16, 16), False)
+            draws.append(_Draw(key, (16, 16, 528, 528)))
         else:
-            pfp = Image.open(f"assets/images/profile/default/pfp-default.png")
-        bg.paste(pfp, (16, 16))
-        write = ImageDraw.Draw(bg)
-        font_progress = self.font_progress
-        write.text((568, 47), player.nickname, anchor="lt", font=font_progress)
-        write.text((568, 120), player.playerid, anchor="lt", font=font_progress)
-        write.text(
-            (569, 192),
-            "{:,}".format(player.total_score),
-            anchor="lt",
-            font=font_progress,
+            draws.append(self._paste("pfp", self.pfp_default, (16, 16), False))
+
+        draws.append(self._text((568, 47), player.nickname, "font_progress", "lt"))
+        draws.append(self._text((568, 120), player.playerid, "font_progress", "lt"))
+        draws.append(
+            self._text(
+                (569, 192),
+                "{:,}".format(player.total_score),
+                "font_progress",
+                "lt",
+            )
         )
-        write.text(
-            (1088, 192),
-            "#{:,}".format(player.total_rank),
-            anchor="rt",
-            font=font_progress,
+        draws.append(
+            self._text(
+                (1088, 192),
+                "#{:,}".format(player.total_rank),
+                "font_progress",
+                "rt",
+            )
         )
 
         scores_x = 276
@@ -150,66 +337,82 @@ class Images:
         c = 0
 
         creation_date = datetime.strptime(player.created_at, "%Y-%m-%d")
-        write.text(
-            (24, 1260),
-            f"EST  {creation_date.strftime('%d.%m.%Y')}",
-            anchor="lt",
-            font=self.font_scores,
+        draws.append(
+            self._text(
+                (24, 1260),
+                f"EST  {creation_date.strftime('%d.%m.%Y')}",
+                "font_scores",
+                "lt",
+            )
         )
 
         for level in self.levels:
             level_score = player.score(level)
-            write.text(
-                (scores_x, scores_y),
-                "{:,}".format(level_score.score),
-                anchor="rs",
-                font=self.font_scores,
+            draws.append(
+                self._text(
+                    (scores_x, scores_y),
+                    "{:,}".format(level_score.score),
+                    "font_scores",
+                    "rs",
+                )
             )
-            write.text(
-                (scores_x2, scores_y),
-                "#{:,}".format(int(level_score.rank)),
-                anchor="rs",
-                font=self.font_scores,
+            draws.append(
+                self._text(
+                    (scores_x2, scores_y),
+                    "#{:,}".format(int(level_score.rank)),
+                    "font_scores",
+                    "rs",
+                )
             )
             if level == "zecred":
-                write.text(
-                    (scores_x2 - 384, scores_y - 192),
-                    "{:,}".format(player.replays),
-                    anchor="rs",
-                    font=self.font_scores,
+                draws.append(
+                    self._text(
+                        (scores_x2 - 384, scores_y - 192),
+                        "{:,}".format(player.replays),
+                        "font_scores",
+                        "rs",
+                    )
                 )
-                write.text(
-                    (scores_x2 - 384, scores_y - 128),
-                    "{:,}".format(player.issues),
-                    anchor="rs",
-                    font=self.font_scores,
+                draws.append(
+                    self._text(
+                        (scores_x2 - 384, scores_y - 128),
+                        "{:,}".format(player.issues),
+                        "font_scores",
+                        "rs",
+                    )
                 )
 
                 scores_y += 64
                 s = player.daily_quest
                 lvl_score = s.score if s is not None else 0
                 lvl_rank = s.rank if s is not None else 0
-                write.text(
-                    (scores_x, scores_y),
-                    "{:,}".format(lvl_score),
-                    anchor="rs",
-                    font=self.font_scores,
+                draws.append(
+                    self._text(
+                        (scores_x, scores_y),
+                        "{:,}".format(lvl_score),
+                        "font_scores",
+                        "rs",
+                    )
                 )
-                write.text(
-                    (scores_x2, scores_y),
-                    "#{:,}".format(lvl_rank),
-                    anchor="rs",
-                    font=self.font_scores,
+                draws.append(
+                    self._text(
+                        (scores_x2, scores_y),
+                        "#{:,}".format(lvl_rank),
+                        "font_scores",
+                        "rs",
+                    )
                 )
                 scores_y += 64
                 s = player.skill_point
                 lvl_score = s.score if s is not None else 0
                 lvl_rank = s.rank if s is not None else 0
-                write.text(
-                    (scores_x, scores_y),
-                    "{:,}".format(lvl_score),
-                    anchor="rs",
-                    font=self.font_scores,
+                draws.append(
+                    self._text(
+                        (scores_x, scores_y),
+                        "{:,}".format(lvl_score),
+                        "font_scores",
+                        "rs",
+                    )
                 )
                 scores_y = 698 - (5 * 128)
                 scores_x += 128 * 3
@@ -232,7 +435,6 @@ class Images:
                 scores_x -= 128 * 6
                 scores_x2 -= 128 * 6
 
-        path = "assets/images/profile"
         badge_x = 24
         badge_y = 536
         colour_code = {
@@ -243,22 +445,19 @@ class Images:
             "#00BCD4": 5,
         }
         badge_c = 0
-        for badge_name in badge_keys:
-            badge_c += 1
+        for badge_name, badge_value in player.badges.items():
             extra = ""
-            rar = badge_values[badge_keys.index(badge_name)][0]
+            rar = badge_value[0]
             if badge_name == "of-merit":
-                extra = "-" + str(
-                    colour_code[badge_values[badge_keys.index(badge_name)][1]]
-                )
+                extra = "-" + str(colour_code[badge_value[1]])
 
-            try:
-                badge = Image.open(f"{path}/badges/pb-{rar}-{badge_name}{extra}.png")
-            except FileNotFoundError:
-                badge_c -= 1
+            name = f"{rar}-{badge_name}{extra}"
+            badge = self.badges.get(name)
+            if badge is None:
                 continue
-            
-            bg.paste(badge, (badge_x, badge_y), badge)
+            badge_c += 1
+
+            draws.append(self._paste(name, badge, (badge_x, badge_y)))
 
             if badge_c == 9:
                 badge_y -= 128
@@ -267,107 +466,162 @@ class Images:
             else:
                 badge_x += 128
 
-        if badge_c > 5:
-            bg.paste(self.barrier_v, (642, 528), self.barrier_v)
-
-            if badge_c > 6:
-                bg.paste(self.barrier_v, (770, 528), self.barrier_v)
+        barriers, tps = self.layouts[max(5, min(badge_c, 12))]
+        for barrier, xy in barriers:
+            draws.append(self._paste(f"barrier-{barrier.width}", barrier, xy))
 
-                if badge_c > 7:
-                    bg.paste(self.barrier_v, (898, 528), self.barrier_v)
+        lvl_ico = self._season_level_icon(player.season_level)
+        draws.append(self._paste(f"season-{player.season_level}", lvl_ico, (542, 286)))
 
-                    if badge_c > 8:
-                        bg.paste(self.barrier_v, (1026, 528), self.barrier_v)
-
-        if badge_c > 9:
-            bg.paste(self.barrier_h, (1040, 514), self.barrier_h)
-
-            if badge_c == 11:
-                bg.paste(self.barrier_h, (912, 514), self.barrier_h)
-                bg.paste(self.barrier_v, (1026, 400), self.barrier_v)
-                default_tps_v[7][4] = "teal"
-
-            else:
-                default_tps_h[4][8] = "teal"
-                default_tps_v[8][4] = "teal"
-
-        else:
-            default_tps_h[4][8] = "teal"
-            default_tps_h[4][9] = "teal"
-
-        if player.season_level < 150:
-            lvl_ico = Image.open(
-                f"{path}/levels/player-level-{player.season_level}.png"
+        draws.append(
+            self._text(
+                (854, 307),
+                "{:} / {:}".format(player.season_xp, player.season_xp_max),
+                "font_lvl_small",
+                "rt",
             )
-        else:
-            level = str(player.season_level)
-            lvl_ico = Image.open(f"{path}/levels/player-level-max.png")
-            xy = 12, 23
-            lvl_ico.paste(self.digits[level[0]], xy, self.digits[level[0]])
-
-            xy = 24, 23
-            lvl_ico.paste(self.digits[level[1]], xy, self.digits[level[1]])
-
-            xy = 36, 23
-            lvl_ico.paste(self.digits[level[2]], xy, self.digits[level[2]])
-            lvl_ico = lvl_ico.resize((100, 100))
-
-        bg.paste(lvl_ico, (542, 286), lvl_ico)
-
-        write.text(
-            (854, 307),
-            "{:} / {:}".format(player.season_xp, player.season_xp_max),
-            anchor="rt",
-            font=self.font_lvl_small,
         )
-        write.rectangle(((656, 346), (890, 364)), fill="#191919")
+        draws.append(self._rectangle((656, 346, 890, 364), "#191919"))
         x = int((890 - 656) * (player.season_xp / player.season_xp_max) + 656)
-        write.rectangle(((656, 346), (x, 364)), fill="#8dc14b")
+        draws.append(self._rectangle((656, 346, x, 364), "#8dc14b"))
+
+        level = min(player.level, 120)
+        lvl_ico = self.profile_levels[level]
+        draws.append(self._paste(f"profile-{level}", lvl_ico, (542, 414)))
+
+        draws.append(
+            self._text(
+                (854, 435),
+                "{:} / {:}".format(player.xp, player.xp_max),
+                "font_lvl_small",
+                "rt",
+            )
+        )
+        draws.append(self._rectangle((656, 474, 890, 492), "#191919"))
+        x = int((890 - 656) * (player.xp / player.xp_max) + 656)
+        draws.append(self._rectangle((656, 474, x, 492), "#757575"))
+
+        draws.append(self._paste("teleporters", self.tp_layer, (0, 0)))
+        for tp, xy in tps:
+            draws.append(self._paste(f"tp-{tp.width}-{xy}", tp, xy))
+
+        return draws
+
+    def _paint(
+        self, bg: Image.Image, draws: list[_Draw], box: tuple[int, int, int, int]
+    ) -> Image.Image:
+        """Paints the part of the profile inside box onto a crop of bg."""
+        x0, y0, x1, y1 = box
+        im = bg.crop(box)
+        write = ImageDraw.Draw(im)
+        for draw in draws:
+            left, top, right, bottom = draw.box
+            if left >= x1 or right <= x0 or top >= y1 or bottom <= y0:
+                continue
 
-        level = str(player.level) if player.level < 121 else "120"
+            kind = draw.key[0]
+            if kind == "text":
+                _, (x, y), text, font, anchor = draw.key
+                write.text(
+                    (x - x0, y - y0), text, anchor=anchor, font=getattr(self, font)
+                )
+            elif kind == "paste":
+                _, _, (x, y), masked = draw.key
+                assert draw.image is not None
+                im.paste(draw.image, (x - x0, y - y0), draw.image if masked else None)
+            else:
+                _, (left, top, right, bottom), fill = draw.key
+                write.rectangle(
+                    ((left - x0, top - y0), (right - x0, bottom - y0)), fill=fill
+                )
+        return im
 
-        lvl_ico = Image.open(f"{path}/profile-levels/profile-level-{level}.png")
-        bg.paste(lvl_ico, (542, 414), lvl_ico)
+    def profile_image(
+        self,
+        player: Player,
+        avatar_bytes: bytes | None = None,
+        userid: int | None = None,
+        previous: tuple[Player, str | None, bytes] | None = None,
+    ) -> Image.Image:
+        """Draws the profile image for the profile command.
+
+        previous may hold the player, avatar digest and png of an earlier
+        render of this profile with the same background, only the parts that
+        changed since are repainted onto it then.
+        """
+        try:
+            bg = Image.open(f"assets/images/profile/custom/{userid}.png")
+        except FileNotFoundError:
+            bg = self.background
+
+        draws = self._profile_draws(player, avatar_bytes)
+        full = 0, 0, bg.width, bg.height
+
+        damage: list[tuple[int, int, int, int]] = [full]
+        if previous is not None:
+            before = self._profile_draws(previous[0], avatar_digest=previous[1])
+            old = {draw.key for draw in before}
+            new = {draw.key for draw in draws}
+            damage = [draw.box for draw in before if draw.key not in new]
+            damage += [draw.box for draw in draws if draw.key not in old]
+
+        # repainting most of the image is not worth it over a full render
+        area = sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in damage)
+        if previous is None or area > bg.width * bg.height // 2:
+            return self._paint(bg, draws, full)
+
+        im = Image.open(BytesIO(previous[2]))
+        for x0, y0, x1, y1 in damage:
+            box = max(x0, 0), max(y0, 0), min(x1, bg.width), min(y1, bg.height)
+            im.paste(self._paint(bg, draws, box), box[:2])
+        return im
+
+    def encode(self, im: Image.Image, fmt: str = "png") -> BytesIO:
+        """Encodes the image in one of the output formats listed in Images.formats."""
+        _, options = self.formats[fmt]
+        if fmt == "png-palette":
+            im = im.quantize(256, method=Image.Quantize.FASTOCTREE)
+        elif fmt == "jpeg" and im.mode != "RGB":
+            im = im.convert("RGB")
+
+        buffer = BytesIO()
+        im.save(buffer, **options)
+        buffer.seek(0)
+
+        return buffer
 
-        write.text(
-            (854, 435),
-            "{:} / {:}".format(player.xp, player.xp_max),
-            anchor="rt",
-            font=self.font_lvl_small,
-        )
-        write.rectangle(((656, 474), (890, 492)), fill="#191919")
-        x = int((890 - 656) * (player.xp / player.xp_max) + 656)
-        write.rectangle(((656, 474), (x, 492)), fill="#757575")
-
-        x = 16 - 128
-        y = 2
-        for g in range(11):
-            for h in range(15):
-                x += 128
-                try:
-                    colour = default_tps_h[g][h + 1]
-                    bg.paste(self.tp_h[colour], (x, y), self.tp_h[colour])
-                except KeyError:
-                    continue
-            x = 16 - 128
-            y += 128
-        x = 16 - 128
-        y = 2
-        for g in range(16):
-            for h in range(10):
-                x += 128
-                try:
-                    colour = default_tps_v[g][h + 1]
-                    bg.paste(self.tp_v[colour], (y, x), self.tp_v[colour])
-                except KeyError:
-                    continue
-            x = 16 - 128
-            y += 128
-
-        # default_tps = self.default_tps
-
-        final_buffer = BytesIO()
-        bg.save(final_buffer, "png")
-        final_buffer.seek(0)
-
-        return final_buffer
+    def profile_gen(
+        self,
+        player: Player,
+        avatar_bytes: bytes | None = None,
+        userid: int | None = None,
+        previous: tuple[Player, str | None, bytes] | None = None,
+        fmt: str = "png",
+    ) -> BytesIO:
+        """Generates the profile image for the profile command.
+
+        previous is only used for lossless formats, lossy ones would have
+        their artifacts carried over into the next render.
+        """
+        if fmt not in self.lossless:
+            previous = None
+        im = self.profile_image(player, avatar_bytes, userid, previous)
+        return self.encode(im, fmt)
+
+    def benchmark_formats(
+        self,
+        player: Player,
+        avatar_bytes: bytes | None = None,
+        userid: int | None = None,
+    ) -> list[tuple[str, float, int]]:
+        """Renders the profile once and encodes it in every format.
+
+        Returns the format, encode time in seconds and size in bytes of each.
+        """
+        im = self.profile_image(player, avatar_bytes, userid)
+        results: list[tuple[str, float, int]] = []
+        for fmt in self.formats:
+            start = time.perf_counter()
+            buffer = self.encode(im, fmt)
+            results.append((fmt, time.perf_counter() - start, len(buffer.getvalue())))
+        return results
@@ -0,0 +1,132 @@
+from __future__ import annotations
+
+# std
+from datetime import datetime
+from typing import Any, Mapping
+
+try:
+    import zstandard
+except ImportError:  # optional, content is stored uncompressed without it
+    zstandard = None
+
+# version of the compact message documents, documents without "v" are version 1
+SCHEMA_VERSION = 2
+# shorter content isn't worth compressing
+COMPRESS_MIN_LENGTH = 128
+
+# bits of the "f" field
+FLAGS = (
+    "bot",
+    "activity",
+    "mention_everyone",
+    "pinned",
+    "reference",
+    "system",
+    "webhook",
+)
+
+_compressor = zstandard.ZstdCompressor(level=3) if zstandard is not None else None
+_decompressor = zstandard.ZstdDecompressor() if zstandard is not None else None
+
+
+def _datetime(value: datetime | str | None) -> datetime | None:
+    # version 1 documents written by fetchall hold isoformat strings
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+
+def compact_message(
+    parsed: Mapping[str, Any], channel_id: int, *, compress: bool = False
+) -> dict[str, Any]:
+    """Converts a message parsed by Stats._parse_message into a version 2 document.
+
+    Authors and mentioned users are only referenced by id, see user_docs.
+    Everything derivable is dropped: clean_content, jump_url, the counts of
+    the arrays and the names of mentioned channels and roles. Empty and
+    false values are left out entirely. With ``compress`` long content is
+    stored zstd compressed in "z" instead of "m", when zstandard is installed.
+    Read the content back with message_content.
+    """
+    flags = 0
+    for bit, name in enumerate(FLAGS):
+        if parsed[name]:
+            flags |= 1 << bit
+
+    doc: dict[str, Any] = {
+        "_id": parsed["id"],
+        "v": SCHEMA_VERSION,
+        "c": channel_id,
+        "a": parsed["author"]["id"],
+        "t": _datetime(parsed["created_at"]),
+    }
+    optional: dict[str, Any] = {
+        "e": _datetime(parsed["edited_at"]),
+        "f": flags,
+        "at": parsed["attachments_count"],
+        "cp": parsed["components_count"],
+        "em": parsed["embeds_count"],
+        "um": parsed["raw_mentions"],
+        "cm": parsed["raw_channel_mentions"],
+        "rm": parsed["raw_role_mentions"],
+        "r": [
+            [reaction["name"], reaction["count"]] for reaction in parsed["reactions"]
+        ],
+        "s": [sticker["id"] for sticker in parsed["stickers"]],
+    }
+    if parsed["system"] and parsed["system_content"] != parsed["content"]:
+        optional["sc"] = parsed["system_content"]
+    doc.update((key, value) for key, value in optional.items() if value)
+
+    content: str = parsed["content"]
+    if compress and _compressor is not None and len(content) >= COMPRESS_MIN_LENGTH:
+        compressed = _compressor.compress(content.encode())
+        if len(compressed) < len(content):
+            doc["z"] = compressed
+            return doc
+    if content:
+        doc["m"] = content
+    return doc
+
+
+def user_docs(parsed: Mapping[str, Any]) -> dict[int, dict[str, Any]]:
+    """Returns the documents of the users collection for the author and mentions."""
+    return {
+        user["id"]: {
+            "n": user["name"],
+            "d": user["discriminator"],
+            "b": user["bot"],
+            "s": user["system"],
+        }
+        for user in (parsed["author"], *parsed["mentions"])
+    }
+
+
+def message_content(doc: Mapping[str, Any]) -> str:
+    if "z" in doc:
+        if _decompressor is None:
+            raise RuntimeError("zstandard is required to read compressed messages")
+        return _decompressor.decompress(doc["z"]).decode()
+    return doc.get("m", "")
+
+
+def expand_message(doc: Mapping[str, Any]) -> dict[str, Any]:
+    """Converts a version 2 document into readable, JSON serializable keys."""
+    flags: int = doc.get("f", 0)
+    edited_at: datetime | None = doc.get("e")
+    return {
+        "id": doc["_id"],
+        "channel": doc["c"],
+        "author": doc["a"],
+        "created_at": doc["t"].isoformat(),
+        "edited_at": edited_at.isoformat() if edited_at is not None else None,
+        "content": message_content(doc),
+        **{name: bool(flags & 1 << bit) for bit, name in enumerate(FLAGS)},
+        "attachments_count": doc.get("at", 0),
+        "components_count": doc.get("cp", 0),
+        "embeds_count": doc.get("em", 0),
+        "raw_mentions": doc.get("um", []),
+        "raw_channel_mentions": doc.get("cm", []),
+        "raw_role_mentions": doc.get("rm", []),
+        "reactions": [{"name": n, "count": c} for n, c in doc.get("r", [])],
+        "stickers": doc.get("s", []),
+        "system_content": doc.get("sc"),
+    }
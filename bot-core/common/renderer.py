@@ -0,0 +1,184 @@
+from __future__ import annotations
+
+# std
+import math
+import time
+import asyncio
+import multiprocessing
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable
+
+# packages
+from infinitode import Player
+
+# local
+from common.images import Images
+from common.errors import RendererBusyError, RendererCrashedError
+
+# the Images instance of the current worker process, created by _init_worker
+_images: Images | None = None
+
+
+def _init_worker() -> None:
+    global _images
+    _images = Images()
+
+
+def _warm() -> None:
+    pass
+
+
+def _render(
+    player: Player,
+    avatar_bytes: bytes | None,
+    userid: int | None,
+    previous: tuple[Player, str | None, bytes] | None,
+    fmt: str,
+) -> tuple[bytes, float]:
+    assert _images is not None
+    start = time.perf_counter()
+    buffer = _images.profile_gen(player, avatar_bytes, userid, previous, fmt)
+    return buffer.getvalue(), time.perf_counter() - start
+
+
+def _benchmark(
+    player: Player, avatar_bytes: bytes | None, userid: int | None
+) -> list[tuple[str, float, int]]:
+    assert _images is not None
+    return _images.benchmark_formats(player, avatar_bytes, userid)
+
+
+class ProfileRenderer:
+    """Renders profile images in a pool of worker processes.
+
+    Every worker holds its own Images instance, so Pillow work never
+    competes with the event loop for the GIL. At most ``max_pending``
+    renders may be queued or running at once, any further render raises
+    RendererBusyError with an estimate of when to retry. A pool broken by
+    a crashed worker is replaced, the render is retried once on the new pool.
+    """
+
+    def __init__(
+        self, workers: int = 2, max_pending: int = 8, fmt: str = "png"
+    ) -> None:
+        if fmt not in Images.formats:
+            raise ValueError(f"Unknown profile format: {fmt}")
+
+        self.fmt = fmt
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+
+        self.renders = 0
+        self.rejected = 0
+        self.render_time = 0.0
+        self.wait_time = 0.0
+        self.last_render_time = 0.0
+        self.max_render_time = 0.0
+        self.restarts = 0
+
+        self.executor = self._create_executor()
+
+    def _create_executor(self) -> ProcessPoolExecutor:
+        # spawn instead of fork, forking a process running an event loop is unsafe
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+        )
+
+    def _restart(self, broken: ProcessPoolExecutor) -> None:
+        # concurrent renders may all see the same broken pool, only replace it once
+        if self.executor is not broken:
+            return
+        broken.shutdown(wait=False, cancel_futures=True)
+        self.executor = self._create_executor()
+        self.restarts += 1
+        self.warm()
+
+    async def _run(self, func: Callable[..., Any], *args: Any) -> Any:
+        """Runs func in the pool, replacing the pool once if a worker crashed."""
+        loop = asyncio.get_running_loop()
+        for attempt in range(2):
+            executor = self.executor
+            try:
+                return await loop.run_in_executor(executor, func, *args)
+            except BrokenProcessPool:
+                self._restart(executor)
+                if attempt:
+                    raise RendererCrashedError from None
+
+    async def _submit(self, func: Callable[..., Any], *args: Any) -> Any:
+        """Like _run, but counts towards max_pending and is rejected when full."""
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            batches = self.pending / self.workers + 1
+            raise RendererBusyError(math.ceil(self.average_render_time * batches))
+
+        self.pending += 1
+        try:
+            return await self._run(func, *args)
+        finally:
+            self.pending -= 1
+
+    @property
+    def average_render_time(self) -> float:
+        return self.render_time / self.renders if self.renders else 1.0
+
+    def warm(self) -> None:
+        """Starts all workers so the first renders don't pay the startup cost."""
+        for _ in range(self.workers):
+            self.executor.submit(_warm)
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def render(
+        self,
+        player: Player,
+        avatar_bytes: bytes | None = None,
+        userid: int | None = None,
+        previous: tuple[Player, str | None, bytes] | None = None,
+    ) -> BytesIO:
+        start = time.perf_counter()
+        data, render_time = await self._submit(
+            _render,
+            player,
+            avatar_bytes,
+            userid,
+            previous,
+            self.fmt,
+        )
+
+        self.renders += 1
+        self.render_time += render_time
+        self.wait_time += time.perf_counter() - start - render_time
+        self.last_render_time = render_time
+        self.max_render_time = max(self.max_render_time, render_time)
+
+        return BytesIO(data)
+
+    async def benchmark(
+        self,
+        player: Player,
+        avatar_bytes: bytes | None = None,
+        userid: int | None = None,
+    ) -> list[tuple[str, float, int]]:
+        """Compares encode time and size of every output format on one render."""
+        return await self._submit(_benchmark, player, avatar_bytes, userid)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "Format": self.fmt,
+            "Workers": self.workers,
+            "Pending": f"{self.pending}/{self.max_pending}",
+            "Renders": self.renders,
+            "Rejected": self.rejected,
+            "Restarts": self.restarts,
+            "Average render": f"{self.average_render_time * 1000:0.1f}ms",
+            "Average wait": f"{self.wait_time / max(self.renders, 1) * 1000:0.1f}ms",
+            "Last render": f"{self.last_render_time * 1000:0.1f}ms",
+            "Max render": f"{self.max_render_time * 1000:0.1f}ms",
+        }
@@ -0,0 +1,131 @@
+from __future__ import annotations
+
+# std
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Mapping, Sequence
+
+# packages
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import IndexModel
+from pymongo.errors import OperationFailure
+
+log = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Index:
+    """An index a collection needs.
+
+    ``probe`` is a query the index is meant to serve, it is explained at
+    startup to make sure it doesn't end up as a collection scan.
+    """
+
+    keys: Sequence[tuple[str, Any]]
+    probe: Mapping[str, Any] | None = None
+    options: Mapping[str, Any] = field(default_factory=dict)
+
+    def model(self) -> IndexModel:
+        return IndexModel(list(self.keys), **self.options)
+
+
+# collections that need to be created with options, before anything writes to them
+COLLECTIONS: dict[str, dict[str, Any]] = {
+    "leaderboards": {
+        "timeseries": {"timeField": "ts", "metaField": "meta", "granularity": "hours"},
+        # snapshots are kept for 180 days
+        "expireAfterSeconds": 180 * 24 * 3600,
+    },
+}
+
+INDEXES: dict[str, list[Index]] = {
+    "guildtags": [
+        Index([("guild", 1), ("name", 1)], {"guild": 0, "name": ""}, {"unique": True}),
+    ],
+    "tagversions": [
+        Index([("guild", 1)], {"guild": 0}, {"unique": True}),
+    ],
+    "dailyquest": [
+        Index([("date", 1)], {"date": "2021-05-06"}, {"unique": True}),
+    ],
+    "accountlinks": [
+        Index([("user_id", 1)], {"user_id": 0}, {"unique": True}),
+        Index([("playerid", 1)], {"playerid": ""}, {"unique": True}),
+    ],
+    # documents are shaped {playerid: {"name", "key"}}
+    "nicknames": [
+        Index([("$**", 1)], {"0": {"$exists": True}}),
+    ],
+    "channelmessages": [
+        Index([("c", 1), ("_id", 1)], {"c": 0}),
+    ],
+    "leaderboards": [
+        Index(
+            [
+                ("meta.level", 1),
+                ("meta.mode", 1),
+                ("meta.difficulty", 1),
+                ("meta.beta", 1),
+                ("ts", -1),
+            ],
+            {
+                "meta.level": "1.1",
+                "meta.mode": "score",
+                "meta.difficulty": "NORMAL",
+                "meta.beta": False,
+            },
+        ),
+    ],
+}
+
+
+# indexes no query uses anymore, dropped at startup
+DROPPED_INDEXES: dict[str, list[str]] = {
+    # replaced by the "c" index of the compact message schema
+    "channelmessages": ["channel_1__id_1"],
+}
+
+
+def _collection_scan(plan: Any) -> bool:
+    if isinstance(plan, Mapping):
+        if plan.get("stage") == "COLLSCAN":
+            return True
+        return any(
+            _collection_scan(value)
+            for key, value in plan.items()
+            if key != "rejectedPlans"
+        )
+    if isinstance(plan, list):
+        return any(_collection_scan(value) for value in plan)
+    return False
+
+
+async def ensure_schema(db: AsyncIOMotorDatabase) -> None:
+    """Creates the registered collections and indexes, then verifies them."""
+    existing = set(await db.list_collection_names())
+    for name, options in COLLECTIONS.items():
+        if name not in existing:
+            await db.create_collection(name, **options)
+
+    for name, dropped in DROPPED_INDEXES.items():
+        if name not in existing:
+            continue
+        current = await db[name].index_information()
+        for index in dropped:
+            if index in current:
+                await db[name].drop_index(index)
+
+    for name, indexes in INDEXES.items():
+        col = db[name]
+        try:
+            await col.create_indexes([index.model() for index in indexes])
+        except OperationFailure as err:
+            # most likely an existing index with the same keys but other options
+            log.warning("Could not create the indexes of %s: %s", name, err)
+
+        for index in indexes:
+            if index.probe is None:
+                continue
+            plan: dict[str, Any] = await col.find(index.probe).explain()
+            if _collection_scan(plan.get("queryPlanner", plan)):
+                log.warning("Collection scan on %s for %s", name, dict(index.probe))
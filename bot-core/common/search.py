@@ -0,0 +1,281 @@
+from __future__ import annotations
+
+# std
+import heapq
+from bisect import bisect_left, insort
+from typing import Iterable, Sequence
+
+# keys are compared case-insensitively, this sorts after every lowercase key
+_MAX_CHAR = "\U0010ffff"
+
+
+class PrefixIndex:
+    """Case-insensitive prefix and substring search over a set of strings.
+
+    Keys are kept in a sorted list, so prefix matches are a binary search away.
+    Substring matches are found by scanning one newline-joined buffer of all
+    keys with str.find. Keys changed since the buffer was built are tracked
+    on the side, the buffer is only rebuilt once ``rebuild_after`` changed.
+    """
+
+    def __init__(
+        self,
+        values: Iterable[str] = (),
+        *,
+        prefix_scan: int = 1000,
+        rebuild_after: int = 1000,
+    ) -> None:
+        # how many prefix matches are ranked at most, the rest are ignored
+        self.prefix_scan = prefix_scan
+        self.rebuild_after = rebuild_after
+        self._values: dict[str, str] = {value.lower(): value for value in values}
+        self._keys: list[str] = sorted(self._values)
+        self._buffer: str | None = None
+        # keys added to and removed from _keys since the buffer was built
+        self._added: list[str] = []
+        self._removed: set[str] = set()
+
+    def _changed(self) -> None:
+        if len(self._added) + len(self._removed) > self.rebuild_after:
+            self._buffer = None
+            self._added.clear()
+            self._removed.clear()
+
+    def add(self, value: str) -> None:
+        key = value.lower()
+        if key not in self._values:
+            insort(self._keys, key)
+            if self._buffer is not None:
+                if key in self._removed:
+                    self._removed.discard(key)
+                else:
+                    insort(self._added, key)
+                self._changed()
+        self._values[key] = value
+
+    def discard(self, value: str) -> None:
+        key = value.lower()
+        if self._values.pop(key, None) is None:
+            return
+        del self._keys[bisect_left(self._keys, key)]
+        if self._buffer is not None:
+            index = bisect_left(self._added, key)
+            if index < len(self._added) and self._added[index] == key:
+                del self._added[index]
+            else:
+                self._removed.add(key)
+            self._changed()
+
+    def __contains__(self, value: str) -> bool:
+        return value.lower() in self._values
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def _matches(self, query: str, limit: int) -> tuple[list[str], list[str]]:
+        # up to limit prefix matches and other keys containing the query, sorted
+        keys = self._keys
+        start = bisect_left(keys, query)
+        end = bisect_left(keys, query + _MAX_CHAR, start)
+        prefixed = keys[start : min(end, start + self.prefix_scan)]
+        if not query or len(prefixed) >= limit:
+            return prefixed, []
+
+        if self._buffer is None:
+            self._buffer = "\n" + "\n".join(keys) + "\n"
+        buffer = self._buffer
+        found = set(prefixed)
+        contained: list[str] = []
+
+        pos = buffer.find(query)
+        while pos != -1 and len(contained) < limit:
+            line_start = buffer.rfind("\n", 0, pos) + 1
+            line_end = buffer.find("\n", pos)
+            key = buffer[line_start:line_end]
+            if key not in found and key not in self._removed:
+                contained.append(key)
+                found.add(key)
+            pos = buffer.find(query, line_end)
+
+        contained.extend(
+            key for key in self._added if query in key and key not in found
+        )
+        return prefixed, sorted(contained)
+
+    def search(self, query: str, limit: int = 25) -> list[str]:
+        """Returns up to ``limit`` values containing the query.
+
+        Prefix matches come first, shortest first, followed by the other
+        values containing the query in alphabetical order.
+        """
+        return search_all([self], query, limit)
+
+
+def search_all(
+    indexes: Sequence[PrefixIndex], query: str, limit: int = 25
+) -> list[str]:
+    """Like PrefixIndex.search, over the values of all indexes together."""
+    query = query.lower()
+    prefixed: list[tuple[str, str]] = []
+    contained: list[tuple[str, str]] = []
+    for index in indexes:
+        keys, others = index._matches(query, limit)
+        prefixed.extend((key, index._values[key]) for key in keys)
+        contained.extend((key, index._values[key]) for key in others)
+
+    # an exact match comes first and equal lengths are sorted
+    prefixed.sort(key=lambda match: (len(match[0]), match[0]))
+    contained.sort()
+    results: list[str] = []
+    for _, value in prefixed + contained:
+        if value not in results:
+            results.append(value)
+            if len(results) >= limit:
+                break
+    return results
+
+
+def _trigrams(text: str) -> frozenset[str]:
+    # padded like pg_trgm, so the start and end of a name weigh more
+    padded = f"  {text} "
+    return frozenset(padded[i : i + 3] for i in range(len(padded) - 2))
+
+
+def _deletions(text: str) -> set[str]:
+    # the text with every single character removed, and the text itself
+    return {text, *(text[:i] + text[i + 1 :] for i in range(len(text)))}
+
+
+def _edit_distance(a: str, b: str, bound: int) -> int:
+    """Optimal string alignment distance, or bound + 1 once it exceeds bound."""
+    if abs(len(a) - len(b)) > bound:
+        return bound + 1
+    # the rows of the distance matrix two and one characters of a ago
+    before: list[int] = []
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        row = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            row[j] = min(previous[j] + 1, row[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                # swapped neighbours
+                row[j] = min(row[j], before[j - 2] + 1)
+        if min(row) > bound:
+            return bound + 1
+        before, previous = previous, row
+    return min(previous[-1], bound + 1)
+
+
+class TrigramIndex:
+    """Fuzzy, case-insensitive search over a set of short names.
+
+    Names are ranked by the Dice coefficient of their trigrams with the query.
+    Names containing the query rank above all others, prefix matches first.
+    Typos sharing few trigrams, like swapped letters in short names, are
+    found through the names sharing a single character deletion with the
+    query and scored by a bounded edit distance instead.
+    """
+
+    def __init__(self, names: Iterable[str] = ()) -> None:
+        self._grams: dict[str, frozenset[str]] = {}
+        self._postings: dict[str, set[str]] = {}
+        # single character deletions -> the names they were made from
+        self._neighbours: dict[str, set[str]] = {}
+        for name in names:
+            self.add(name)
+
+    def add(self, name: str) -> None:
+        name = name.lower()
+        if name in self._grams:
+            return
+        grams = self._grams[name] = _trigrams(name)
+        for gram in grams:
+            self._postings.setdefault(gram, set()).add(name)
+        for deletion in _deletions(name):
+            self._neighbours.setdefault(deletion, set()).add(name)
+
+    def discard(self, name: str) -> None:
+        name = name.lower()
+        grams = self._grams.pop(name, None)
+        if grams is None:
+            return
+        for gram in grams:
+            posting = self._postings[gram]
+            posting.discard(name)
+            if not posting:
+                del self._postings[gram]
+        for deletion in _deletions(name):
+            neighbours = self._neighbours[deletion]
+            neighbours.discard(name)
+            if not neighbours:
+                del self._neighbours[deletion]
+
+    def __contains__(self, name: str) -> bool:
+        return name.lower() in self._grams
+
+    def __len__(self) -> int:
+        return len(self._grams)
+
+    def search(
+        self, query: str, limit: int | None = 25, *, threshold: float = 0.0
+    ) -> list[str]:
+        """Returns the names most similar to the query, best first.
+
+        Names scoring below ``threshold`` (0 to 1) are left out unless they
+        contain the query.
+        """
+        query = query.lower()
+        if not query:
+            if limit is None:
+                return sorted(self._grams)
+            return heapq.nsmallest(limit, self._grams)
+
+        grams = _trigrams(query)
+        shared: dict[str, int] = {}
+        for gram in grams:
+            for name in self._postings.get(gram, ()):
+                shared[name] = shared.get(name, 0) + 1
+        if len(query) < 3:
+            # too short to share an inner trigram with the names containing it
+            for name in self._grams:
+                if query in name:
+                    shared.setdefault(name, 0)
+
+        scores: dict[str, float] = {}
+        for name, count in shared.items():
+            score = 2 * count / (len(grams) + len(self._grams[name]))
+            if name.startswith(query):
+                score += 2
+            elif query in name:
+                score += 1
+            scores[name] = score
+
+        if len(query) >= 3:
+            # swapped letters break most trigrams of short names, "hlep" shares
+            # a single one with "help", so names sharing a single character
+            # deletion with the query are scored by edit distance
+            candidates = {
+                name
+                for deletion in _deletions(query)
+                for name in self._neighbours.get(deletion, ())
+            }
+            bound = 1 if len(query) < 8 else 2
+            for name in candidates:
+                if scores.get(name, 0) >= 1:
+                    continue
+                distance = _edit_distance(query, name, bound)
+                if distance <= bound:
+                    score = 1 - distance / max(len(query), len(name))
+                    scores[name] = max(scores.get(name, 0.0), score)
+
+        scored = [(score, name) for name, score in scores.items() if score >= threshold]
+
+        def key(item: tuple[float, str]) -> tuple[float, str]:
+            return -item[0], item[1]
+
+        if limit is None:
+            scored.sort(key=key)
+        else:
+            scored = heapq.nsmallest(limit, scored, key=key)
+        return [name for _, name in scored]
@@ -2,8 +2,10 @@ from __future__ import annotations
 
 # std
 import json
+import time
+import asyncio
 from math import floor, ceil
-from typing import Any, Iterable
+from typing import Any, Awaitable, Iterable
 
 # packages
 from discord import app_commands
@@ -13,6 +15,63 @@ def codeblock(instring: str, /, language: str = "") -> str:
     return f"```{language}\n{instring}```"
 
 
+async def fan_out(
+    *aws: Awaitable[Any], limit: int = 4, timeout: float | None = 10.0
+) -> list[Any]:
+    """Runs independent requests concurrently, at most ``limit`` at once.
+
+    Every request gets ``timeout`` seconds. If any of them fails, the others
+    are cancelled and the error is raised. Results keep the order of ``aws``.
+    """
+    sem = asyncio.Semaphore(limit)
+
+    async def run(aw: Awaitable[Any]) -> Any:
+        started = False
+        try:
+            async with sem:
+                started = True
+                return await asyncio.wait_for(aw, timeout)
+        finally:
+            # cancelled while waiting for the semaphore, don't leak the coroutine
+            if not started and asyncio.iscoroutine(aw):
+                aw.close()
+
+    futures = [asyncio.ensure_future(run(aw)) for aw in aws]
+    try:
+        return await asyncio.gather(*futures)
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        raise
+
+
+class RateLimiter:
+    """Token bucket allowing ``rate`` acquisitions per second, shared by all callers.
+
+    Up to ``burst`` acquisitions may happen at once after being idle.
+    """
+
+    def __init__(self, rate: float, burst: int = 1) -> None:
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._tokens = 1
+                self._updated = time.monotonic()
+            self._tokens -= 1
+
+
 def load_json(filename: Any):
     with open(filename, encoding="utf-8") as infile:
         return json.load(infile)
@@ -5,7 +5,9 @@ import re
 import time
 import asyncio
 import traceback
-from typing import Any, Literal, overload, TYPE_CHECKING
+from io import BytesIO
+from collections import Counter
+from typing import Literal, overload, TYPE_CHECKING
 
 # packages
 import aiohttp
@@ -16,10 +18,16 @@ from infinitode import Player
 from infinitode.errors import APIError, BadArgument
 
 # local
+import config
+from exts.database import Database
 from common.custom import Context, app_check_channel
+from common.cache import TTLCache
 from common.images import Images
-from common.utils import codeblock, create_choices
+from common.search import PrefixIndex, search_all
+from common.renderer import ProfileRenderer
+from common.utils import codeblock, fan_out
 from common.errors import (
+    APITimeoutError,
     BadChannel,
     InCommandError,
     InvalidPlayerError,
@@ -34,7 +42,41 @@ class Account(commands.Cog):
     def __init__(self, bot: Advinas) -> None:
         self.bot = bot
         self.mention_regex = re.compile(r"<@!?([0-9]+)>")
-        self.images = Images()
+        self.renderer = ProfileRenderer(
+            workers=getattr(config, "render_workers", 2),
+            max_pending=getattr(config, "render_max_pending", 8),
+            fmt=getattr(config, "profile_format", "png"),
+        )
+        self.renderer.warm()
+        # rendered profiles keyed by Images.profile_key
+        self.render_cache: TTLCache[str, bytes] = TTLCache(
+            maxsize=256,
+            ttl=getattr(config, "render_cache_ttl", 300),
+            max_bytes=getattr(config, "render_cache_bytes", 64 * 2**20),
+            sizeof=len,
+        )
+        # the last render of each (playerid, user id), so refreshes only repaint
+        # what changed. Holds the player, avatar digest, image and background version
+        self.last_renders: TTLCache[
+            tuple[str, int], tuple[Player, str | None, bytes, int | None]
+        ] = TTLCache(
+            maxsize=256,
+            ttl=self.render_cache.ttl,
+            max_bytes=getattr(config, "last_render_bytes", 32 * 2**20),
+            sizeof=lambda last: len(last[2]),
+        )
+        # discord user id -> linked playerid, and the other way around
+        self.links: dict[int, str] = {}
+        self.link_owners: dict[str, int] = {}
+        # set once ready loaded the links and nicknames, lookups wait for it
+        self.loaded = asyncio.Event()
+        # playerids and lowercase nicknames for the playerid autocomplete, kept
+        # apart so discarding a nickname never removes an equal playerid
+        self.playerid_index = PrefixIndex()
+        self.nickname_index = PrefixIndex()
+        self.nicknames: dict[str, str] = {}
+        # how many players use each nickname, shared ones stay in the index
+        self.nickname_counts: Counter[str] = Counter()
         self.ctx_menu = app_commands.ContextMenu(
             name="profile",
             callback=self.profile_context_menu,
@@ -46,17 +88,30 @@ class Account(commands.Cog):
     async def ready(self) -> None:
         await self.bot.wait_until_ready()
         await asyncio.sleep(3)
-        self.accounts = self.bot.DB.discordnames
+        self.accounts = self.bot.DB.accountlinks
         self.nicks = self.bot.DB.nicknames
-        payload: list[dict[str, Any]] = await self.nicks.find({}, {"_id": 0}).to_list(
-            None
-        )
-        self.PLAYERIDS = {next(iter(doc.values()))["key"] for doc in payload} | {
-            next(iter(doc)) for doc in payload
-        }
+        # one document per finished migration, _id being its name
+        self.migrations = self.bot.DB.migrations
+        try:
+            if await self.migrations.find_one({"_id": "accountlinks"}) is None:
+                await self._migrate_links()
+                await self.migrations.insert_one({"_id": "accountlinks"})
+            async for doc in self.accounts.find({}, {"_id": 0}):
+                self.links[doc["user_id"]] = doc["playerid"]
+                self.link_owners[doc["playerid"]] = doc["user_id"]
+            async for doc in self.nicks.find({}, {"_id": 0}):
+                for playerid, nickname in doc.items():
+                    self.nicknames[playerid] = nickname["key"]
+            self.nickname_counts = Counter(self.nicknames.values())
+            self.playerid_index = PrefixIndex(self.nicknames)
+            self.nickname_index = PrefixIndex(self.nickname_counts)
+        finally:
+            # lookups go ahead with whatever was loaded instead of hanging forever
+            self.loaded.set()
 
     async def cog_unload(self) -> None:
         self.bot.tree.remove_command(self.ctx_menu.name, type=self.ctx_menu.type)
+        self.renderer.shutdown()
 
     async def cog_check(self, ctx: Context) -> bool:
         if ctx.guild and ctx.guild.id == 590288287864848387:
@@ -64,23 +119,75 @@ class Account(commands.Cog):
                 raise BadChannel
         return True
 
+    async def _migrate_links(self) -> None:
+        """Copies the links of the old discordnames collection into accountlinks.
+
+        The old documents are shaped {playerid: user_id}, a user may appear
+        more than once there but only the last link is kept. Links that
+        already exist in accountlinks are left untouched.
+        """
+        owners: dict[str, int] = {}
+        async for doc in self.bot.DB.discordnames.find({}, {"_id": 0}):
+            for playerid, user_id in doc.items():
+                owners[playerid] = int(user_id)
+        links = {user_id: playerid for playerid, user_id in owners.items()}
+        if links:
+            await Database.upsert(
+                self.accounts,
+                [{"user_id": user_id} for user_id in links],
+                [
+                    {"user_id": user_id, "playerid": playerid}
+                    for user_id, playerid in links.items()
+                ],
+                insert_only=True,
+            )
+
     async def add_connection(self, playerid: str, user_id: int | str) -> None:
+        await self.loaded.wait()
+        user_id = int(user_id)
+        # a playerid can only be linked to one user
+        await self.accounts.delete_many(
+            {"playerid": playerid, "user_id": {"$ne": user_id}}
+        )
         await self.accounts.update_one(
-            {playerid: {"$exists": True}},
-            {"$set": {playerid: str(user_id)}},
+            {"user_id": user_id},
+            {"$set": {"playerid": playerid}},
             upsert=True,
         )
 
+        previous_owner = self.link_owners.pop(playerid, None)
+        if previous_owner is not None:
+            self.links.pop(previous_owner, None)
+        previous_playerid = self.links.get(user_id)
+        if previous_playerid is not None:
+            self.link_owners.pop(previous_playerid, None)
+        self.links[user_id] = playerid
+        self.link_owners[playerid] = user_id
+
     async def add_nickname(self, player: Player) -> None:
-        data = {
-            player.playerid: {"name": player.nickname, "key": player.nickname.lower()}
-        }
+        await self.loaded.wait()
+        key = player.nickname.lower()
+        if self.nicknames.get(player.playerid) == key:
+            return
+
+        data = {player.playerid: {"name": player.nickname, "key": key}}
         await self.nicks.update_one(
-            data,
+            {player.playerid: {"$exists": True}},
             {"$set": data},
             upsert=True,
         )
 
+        previous = self.nicknames.get(player.playerid)
+        self.nicknames[player.playerid] = key
+        if previous is not None:
+            self.nickname_counts[previous] -= 1
+            if self.nickname_counts[previous] <= 0:
+                del self.nickname_counts[previous]
+                self.nickname_index.discard(previous)
+        self.nickname_counts[key] += 1
+        self.playerid_index.add(player.playerid)
+        self.nickname_index.add(key)
+
     @overload
     async def find_connection(
         self, user_id: int | str, raw: Literal[False] = False
@@ -94,18 +201,21 @@ class Account(commands.Cog):
     async def find_connection(
         self, user_id: int | str, raw: bool = False
     ) -> dict[str, str] | str | None:
-        data: dict[str, str] | None = await self.accounts.find_one(
-            {"$text": {"$search": str(user_id)}},
-            {"_id": 0},
-        )
-        if data is None or raw:
-            return data
-        return next(iter(data))
+        await self.loaded.wait()
+        try:
+            playerid = self.links.get(int(user_id))
+        except ValueError:
+            return None
+        if playerid is None or not raw:
+            return playerid
+        return {playerid: str(user_id)}
 
     async def remove_connection(self, user_id: int):
-        await self.accounts.delete_one(
-            {"$text": {"$search": str(user_id)}},
-        )
+        await self.loaded.wait()
+        await self.accounts.delete_one({"user_id": user_id})
+        playerid = self.links.pop(user_id, None)
+        if playerid is not None:
+            self.link_owners.pop(playerid, None)
 
     @commands.hybrid_group(
         name="account",
@@ -200,7 +310,7 @@ class Account(commands.Cog):
 
     async def _find_player_mention(self, playerid: str) -> dict[str, str] | None:
         match = self.mention_regex.search(playerid)
-        _id = match[0] if match else playerid
+        _id = match[1] if match else playerid
         return await self.find_connection(_id, True)
 
     async def _find_player_name(self, playerid: str) -> dict[str, str] | None:
@@ -208,22 +318,50 @@ class Account(commands.Cog):
         if member:
             return await self.find_connection(member.id, True)
 
+    async def _fetch_avatar(self, url: str) -> bytes | None:
+        try:
+            async with self.bot.session.get(
+                url, raise_for_status=True, timeout=aiohttp.ClientTimeout(total=5)
+            ) as r:
+                return await r.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return None
+
     async def _generate_player(self, user_id: int, player: Player) -> discord.File:
+        # independent requests, so the wait is the slowest of them and not the sum
         try:
-            r = await self.bot.session.get(player.avatar_link, raise_for_status=True)
-        except aiohttp.ClientResponseError:
-            avatar_bytes = None
+            avatar_bytes, *_ = await fan_out(
+                self._fetch_avatar(player.avatar_link),
+                player.fetch_daily_quest(self.bot.API),
+                player.fetch_skill_point(self.bot.API),
+            )
+        except asyncio.TimeoutError:
+            raise APITimeoutError from None
+
+        key = Images.profile_key(player, avatar_bytes, user_id)
+        data: bytes | None = self.render_cache.get(key)
+        if data is None:
+            version = Images.background_version(user_id)
+            previous = None
+            last = self.last_renders.peek((player.playerid, user_id))
+            if last is not None and last[3] == version:
+                previous = last[:3]
+
+            final_buffer = await self.renderer.render(
+                player, avatar_bytes, user_id, previous
+            )
+            data = final_buffer.getvalue()
+            self.render_cache.set(key, data)
+            if self.renderer.fmt in Images.lossless:
+                digest = Images.avatar_digest(avatar_bytes)
+                self.last_renders.set(
+                    (player.playerid, user_id), (player, digest, data, version)
+                )
         else:
-            avatar_bytes = await r.read()
+            final_buffer = BytesIO(data)
 
-        await player.fetch_daily_quest(self.bot.API)
-        await player.fetch_skill_point(self.bot.API)
-
-        final_buffer = await self.bot.loop.run_in_executor(
-            None, self.images.profile_gen, player, avatar_bytes, user_id
-        )
-
-        return discord.File(filename=f"{player.playerid}.png", fp=final_buffer)
+        extension, _ = Images.formats[self.renderer.fmt]
+        return discord.File(filename=f"{player.playerid}.{extension}", fp=final_buffer)
 
     # Profile command
     @commands.hybrid_command(
@@ -266,18 +404,42 @@ class Account(commands.Cog):
             f"Finished in {time.perf_counter() - start_time:0.3f}s", file=file
         )
 
+    @commands.command(name="renderstats")
+    @commands.is_owner()
+    async def _renderstats(self, ctx: Context) -> None:
+        em = discord.Embed(title="Profile Renderer", colour=60415)
+        for name, value in self.renderer.stats().items():
+            em.add_field(name=name, value=value)
+        for name, value in self.render_cache.stats().items():
+            em.add_field(name=f"Cache {name.lower()}", value=value)
+        for name, value in self.last_renders.stats().items():
+            em.add_field(name=f"Previous {name.lower()}", value=value)
+        await ctx.reply(embed=em)
+
+    @commands.command(name="profilebench")
+    @commands.is_owner()
+    async def _profilebench(self, ctx: Context, playerid: str | None = None) -> None:
+        async with ctx.typing():
+            player = await self._find_player(ctx.author, playerid)
+            await player.fetch_daily_quest(self.bot.API)
+            await player.fetch_skill_point(self.bot.API)
+            results = await self.renderer.benchmark(player, None, ctx.author.id)
+
+        lines = [f"{'Format':<12} {'Encode':>9} {'Size':>10}"]
+        for fmt, encode_time, size in results:
+            lines.append(
+                f"{fmt:<12} {encode_time * 1000:>7.1f}ms {size / 1024:>7.1f}KiB"
+            )
+        await ctx.reply(codeblock("\n".join(lines)))
+
     @profile.autocomplete("playerid")
     async def playerid_autocomplete(
         self, inter: Interaction, current: str
     ) -> list[app_commands.Choice[str]]:
-        current = current.lower()
-        return create_choices(
-            {
-                i
-                for i in self.PLAYERIDS
-                if i.lower().startswith(current) or current in i.lower()
-            }
-        )
+        return [
+            app_commands.Choice(name=value, value=value)
+            for value in search_all([self.playerid_index, self.nickname_index], current)
+        ]
 
     # Profile context menu
     @app_check_channel()
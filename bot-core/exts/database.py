@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 # std
+import time
 import asyncio
 import datetime
 from motor.motor_asyncio import AsyncIOMotorCollection
@@ -9,10 +10,33 @@ from typing import Any, Mapping, Sequence, TYPE_CHECKING
 # packages
 import discord
 from discord.ext import commands, tasks
+from infinitode import Leaderboard
+from infinitode.core import SUPPORTED_MAPS
+from infinitode.errors import InfinitodeError
+from pymongo import UpdateOne
 
 # local
+from common.custom import Context
+from common.utils import codeblock, fan_out
+
 if TYPE_CHECKING:
     from bot import Advinas
+    from exts.inf import Inf
+
+# seconds between two leaderboard requests while taking snapshots
+SNAPSHOT_DELAY = 1.0
+# operations per bulk write in Database.upsert
+UPSERT_CHUNK_SIZE = 500
+# the first day with a daily quest leaderboard
+DAILYQUEST_START = datetime.date(2021, 5, 6)
+# days fetched at once while backfilling, each one is two requests
+BACKFILL_CONCURRENCY = 2
+# seconds every backfill worker waits after fetching a day
+BACKFILL_DELAY = 1.0
+# days written and reported at once while backfilling
+BACKFILL_CHUNK_DAYS = 50
+# a date coming back empty this often is never requested again
+BACKFILL_ATTEMPTS = 3
 
 
 class Database(commands.Cog):
@@ -24,28 +48,137 @@ class Database(commands.Cog):
         await self.bot.wait_until_ready()
         await asyncio.sleep(3)
         self.dailyquest = self.bot.DB.dailyquest
+        # _id being a date the api returned empty leaderboards for, and how often
+        self.dailyquest_unavailable = self.bot.DB.dailyquestunavailable
+        self.leaderboards = self.bot.DB.leaderboards
         self.save_dailyquest_leaderboard.start()
+        self.backfill_dailyquest.start()
+        self.snapshot_leaderboards.start()
+
+    @staticmethod
+    def _snapshot_meta(
+        level: str, mode: str, difficulty: str, beta: bool
+    ) -> dict[str, Any]:
+        return {
+            "meta.level": level,
+            "meta.mode": mode,
+            "meta.difficulty": difficulty,
+            "meta.beta": beta,
+        }
+
+    @staticmethod
+    def _snapshot(
+        lb: Leaderboard, now: datetime.datetime, level: str, beta: bool
+    ) -> dict[str, Any]:
+        """Builds the compact snapshot document of the leaderboard.
+
+        The rank of an entry is its index in "p", "n" and "s" + 1.
+        Seasonal snapshots use the level "season".
+        """
+        entries: list[dict[str, Any]] = lb.raw["leaderboards"]
+        doc: dict[str, Any] = {
+            "ts": now,
+            "meta": {
+                "level": level,
+                "mode": lb.mode,
+                "difficulty": lb.difficulty,
+                "beta": beta,
+            },
+            "t": lb.total,
+            "p": [entry["playerid"] for entry in entries],
+            "n": [entry.get("nickname") for entry in entries],
+            "s": [int(entry["score"]) for entry in entries],
+        }
+        if lb.season is not None:
+            doc["season"] = lb.season
+        return doc
+
+    async def latest_snapshot(
+        self, level: str, mode: str, difficulty: str, beta: bool
+    ) -> Leaderboard | None:
+        """Rebuilds the most recent snapshot of the given leaderboard."""
+        doc = await self.leaderboards.find_one(
+            self._snapshot_meta(level, mode, difficulty, beta), sort=[("ts", -1)]
+        )
+        if doc is None:
+            return None
+
+        payload = {
+            "player": {"total": doc["t"]},
+            "leaderboards": [
+                {"playerid": p, "nickname": n, "score": s}
+                for p, n, s in zip(doc["p"], doc["n"], doc["s"])
+            ],
+        }
+        return Leaderboard.from_payload(
+            "leaderboards", level, mode, difficulty, None, payload
+        )
+
+    async def rank_history(
+        self,
+        playerid: str,
+        level: str,
+        mode: str = "score",
+        difficulty: str = "NORMAL",
+        beta: bool = False,
+        *,
+        limit: int = 50,
+    ) -> list[tuple[datetime.datetime, int | None]]:
+        """Returns the player's rank in the latest snapshots, None if unranked."""
+        pipeline: list[dict[str, Any]] = [
+            {"$match": self._snapshot_meta(level, mode, difficulty, beta)},
+            {"$sort": {"ts": -1}},
+            {"$limit": limit},
+            {"$project": {"_id": 0, "ts": 1, "i": {"$indexOfArray": ["$p", playerid]}}},
+        ]
+        return [
+            (doc["ts"], doc["i"] + 1 if doc["i"] >= 0 else None)
+            async for doc in self.leaderboards.aggregate(pipeline)
+        ]
 
     @staticmethod
     async def find_by_key(col: AsyncIOMotorCollection, data: Any) -> Any:
         return await col.find_one({str(data): {"$exists": True}})
 
     @staticmethod
-    async def upsert(col: AsyncIOMotorCollection, filter: Sequence[Any] | Mapping[Any, Any], data: Sequence[Any] | Mapping[Any, Any]) -> None:
+    async def upsert(
+        col: AsyncIOMotorCollection,
+        filter: Sequence[Any] | Mapping[Any, Any],
+        data: Sequence[Any] | Mapping[Any, Any],
+        *,
+        chunk_size: int = UPSERT_CHUNK_SIZE,
+        insert_only: bool = False,
+    ) -> tuple[int, int]:
+        """Upserts one or many documents, returns the matched and upserted counts.
+
+        Sequences are written with unordered bulk writes of ``chunk_size``
+        operations each instead of one round trip per document. With
+        ``insert_only``, documents matching the filter are left untouched.
+        """
+        operator = "$setOnInsert" if insert_only else "$set"
         if isinstance(data, Mapping) and isinstance(filter, Mapping):
-            await col.update_one(
-                filter=filter, update={"$set": data}, upsert=True
+            result = await col.update_one(
+                filter=filter, update={operator: data}, upsert=True
             )
-            return
+            return result.matched_count, int(result.upserted_id is not None)
 
+        matched = upserted = 0
         if isinstance(data, Sequence) and isinstance(filter, Sequence):
             if len(data) != len(filter):
-                return
+                return matched, upserted
 
-            for index, document in enumerate(data):
-                await col.update_one(
-                    filter=filter[index], update={"$set": document}, upsert=True
+            operations = [
+                UpdateOne(f, {operator: document}, upsert=True)
+                for f, document in zip(filter, data)
+            ]
+            for index in range(0, len(operations), chunk_size):
+                result = await col.bulk_write(
+                    operations[index : index + chunk_size], ordered=False
                 )
+                matched += result.matched_count
+                upserted += result.upserted_count
+
+        return matched, upserted
 
     # 12 hours just in case something goes wrong, we have a smaller chance of missing a day
     @tasks.loop(hours=12)
@@ -55,10 +188,32 @@ class Database(commands.Cog):
         date = (discord.utils.utcnow() - datetime.timedelta(days=1)).strftime(
             "%Y-%m-%d"
         )
-        lb = await self.bot.API.daily_quest_leaderboards(date)
-        lb_beta = await self.bot.API.daily_quest_leaderboards(date=date, beta=True)
+        try:
+            lb, lb_beta = await fan_out(
+                self.bot.API.daily_quest_leaderboards(date),
+                self.bot.API.daily_quest_leaderboards(date=date, beta=True),
+                timeout=60,
+            )
+        except asyncio.TimeoutError as err:
+            # raising would stop the loop, backfill_dailyquest saves the day later
+            return await self.bot.task_error(self.save_dailyquest_leaderboard, err)
+
+        data = self._dailyquest_doc(date, lb, lb_beta)
+        await self.upsert(self.dailyquest, {"date": date}, data=data)
+
+        await self.bot.task_completion(
+            self.save_dailyquest_leaderboard, fields={"Date": date}
+        )
+
+    @save_dailyquest_leaderboard.error
+    async def task_error(self, err: BaseException):
+        await self.bot.task_error(self.save_dailyquest_leaderboard, err)
 
-        data = {
+    @staticmethod
+    def _dailyquest_doc(
+        date: str, lb: Leaderboard, lb_beta: Leaderboard
+    ) -> dict[str, Any]:
+        return {
             "date": date,
             "live": {"total": lb.total, "leaderboards": lb.raw["leaderboards"]},
             "beta": {
@@ -66,15 +221,190 @@ class Database(commands.Cog):
                 "leaderboards": lb_beta.raw["leaderboards"],
             },
         }
-        await self.upsert(self.dailyquest, {"date": date}, data=data)
 
+    async def _fetch_dailyquest(self, date: str) -> dict[str, Any] | None:
+        """Fetches the document of the date, None if the api has no leaderboard."""
+        try:
+            lb, lb_beta = await fan_out(
+                self.bot.API.daily_quest_leaderboards(date),
+                self.bot.API.daily_quest_leaderboards(date=date, beta=True),
+                timeout=60,
+            )
+        finally:
+            await asyncio.sleep(BACKFILL_DELAY)
+        # the api serves an empty leaderboard for dates it doesn't have anymore
+        if not lb or not lb_beta:
+            return None
+        return self._dailyquest_doc(date, lb, lb_beta)
+
+    async def _backfill_day(
+        self, date: str
+    ) -> tuple[str, dict[str, Any] | None] | None:
+        try:
+            return date, await self._fetch_dailyquest(date)
+        except (InfinitodeError, asyncio.TimeoutError):
+            return None
+
+    # fills the gaps save_dailyquest_leaderboard left behind, e.g. during outages
+    @tasks.loop(hours=24)
+    async def backfill_dailyquest(self):
+        """Fetches every day missing since DAILYQUEST_START.
+
+        Days are fetched and written in chunks of BACKFILL_CHUNK_DAYS, each
+        written with Database.upsert, and the progress is reported after
+        every chunk. Days the api returned empty leaderboards for are skipped
+        once that happened BACKFILL_ATTEMPTS times.
+        """
+        start = time.perf_counter()
+        saved: set[str] = set(await self.dailyquest.distinct("date"))
+        saved.update(
+            await self.dailyquest_unavailable.distinct(
+                "_id", {"attempts": {"$gte": BACKFILL_ATTEMPTS}}
+            )
+        )
+        yesterday = (discord.utils.utcnow() - datetime.timedelta(days=1)).date()
+        missing = [
+            date
+            for offset in range((yesterday - DAILYQUEST_START).days + 1)
+            if (date := str(DAILYQUEST_START + datetime.timedelta(days=offset)))
+            not in saved
+        ]
+        if not missing:
+            return
+
+        written = unavailable = failed = 0
+        message: discord.Message | None = None
+        for index in range(0, len(missing), BACKFILL_CHUNK_DAYS):
+            chunk = missing[index : index + BACKFILL_CHUNK_DAYS]
+            results: list[tuple[str, dict[str, Any] | None] | None] = await fan_out(
+                *map(self._backfill_day, chunk),
+                limit=BACKFILL_CONCURRENCY,
+                timeout=None,
+            )
+            docs: list[dict[str, Any]] = []
+            empty: list[str] = []
+            for result in results:
+                if result is None:
+                    failed += 1
+                elif result[1] is None:
+                    empty.append(result[0])
+                else:
+                    docs.append(result[1])
+
+            await self.upsert(
+                self.dailyquest, [{"date": doc["date"]} for doc in docs], data=docs
+            )
+            if empty:
+                await self.dailyquest_unavailable.bulk_write(
+                    [
+                        UpdateOne({"_id": date}, {"$inc": {"attempts": 1}}, upsert=True)
+                        for date in empty
+                    ],
+                    ordered=False,
+                )
+            written += len(docs)
+            unavailable += len(empty)
+
+            done = min(index + BACKFILL_CHUNK_DAYS, len(missing))
+            content = (
+                f"**backfill_dailyquest** {done}/{len(missing)} days: {written} "
+                f"saved, {unavailable} unavailable, {failed} failed"
+            )
+            if message is None:
+                message = await self.bot.task_channel.send(content)
+            else:
+                await message.edit(content=content)
+
+        elapsed = time.perf_counter() - start
         await self.bot.task_completion(
-            self.save_dailyquest_leaderboard, fields={"Date": date}
+            self.backfill_dailyquest,
+            fields={
+                "Missing": str(len(missing)),
+                "Saved": str(written),
+                "Unavailable": str(unavailable),
+                "Failed": str(failed),
+                "Duration": f"{elapsed:0.1f}s",
+                "Throughput": f"{written / elapsed:0.2f} days/s",
+            },
         )
 
-    @save_dailyquest_leaderboard.error
-    async def task_error(self, err: BaseException):
-        await self.bot.task_error(self.save_dailyquest_leaderboard, err)
+    @backfill_dailyquest.error
+    async def backfill_error(self, err: BaseException):
+        await self.bot.task_error(self.backfill_dailyquest, err)
+
+    # leaderboards prefetched by the Inf cog are reused instead of fetched again
+    @tasks.loop(hours=6)
+    async def snapshot_leaderboards(self):
+        now = discord.utils.utcnow()
+        inf: Inf | None = self.bot.get_cog("Inf")  # type: ignore
+        levels = [
+            level.upper() if level.startswith("dq") else level
+            for level in self.bot.LEVELS
+        ]
+        docs: list[dict[str, Any]] = []
+        failed = reused = 0
+
+        for beta in (False, True):
+            try:
+                lb = await self.bot.API.seasonal_leaderboard(beta=beta)
+            except InfinitodeError:
+                failed += 1
+            else:
+                docs.append(self._snapshot(lb, now, "season", beta))
+
+            for level in levels:
+                if level not in SUPPORTED_MAPS:
+                    continue
+                for mode in ("score", "waves"):
+                    for difficulty in ("NORMAL", "ENDLESS_I"):
+                        endless = difficulty == "ENDLESS_I"
+                        if inf is not None and (
+                            lb := inf.warm_leaderboard(level, mode, endless, beta)
+                        ):
+                            reused += 1
+                            docs.append(self._snapshot(lb, now, level, beta))
+                            continue
+
+                        await asyncio.sleep(SNAPSHOT_DELAY)
+                        try:
+                            lb = await self.bot.API.leaderboards(
+                                level, mode=mode, difficulty=difficulty, beta=beta
+                            )
+                        except InfinitodeError:
+                            failed += 1
+                        else:
+                            docs.append(self._snapshot(lb, now, level, beta))
+
+        if docs:
+            await self.leaderboards.insert_many(docs, ordered=False)
+
+        await self.bot.task_completion(
+            self.snapshot_leaderboards,
+            fields={
+                "Snapshots": str(len(docs)),
+                "Reused": str(reused),
+                "Failed": str(failed),
+            },
+        )
+
+    @snapshot_leaderboards.error
+    async def snapshot_error(self, err: BaseException):
+        await self.bot.task_error(self.snapshot_leaderboards, err)
+
+    @commands.command(name="rankhistory")
+    @commands.is_owner()
+    async def _rankhistory(
+        self, ctx: Context, playerid: str, level: str, mode: str = "score"
+    ):
+        history = await self.rank_history(playerid, level, mode)
+        if not history:
+            return await ctx.reply("No snapshots found.")
+
+        lines = [
+            f"{ts.strftime('%d.%m.%Y %H:%M')} {f'#{rank}' if rank else 'unranked'}"
+            for ts, rank in history
+        ]
+        await ctx.reply(codeblock("\n".join(lines)))
 
 
 async def setup(bot: Advinas):
@@ -1,22 +1,25 @@
 from __future__ import annotations
 
 # std
+import time
+import asyncio
 from math import floor, ceil
 from typing import Annotated, Any, TYPE_CHECKING
 
 # packages
 import discord
 from discord import Interaction, app_commands
-from discord.ext import commands
+from discord.ext import commands, tasks
 from infinitode import Leaderboard
-from infinitode.errors import APIError, BadArgument
+from infinitode.core import SUPPORTED_MAPS
+from infinitode.errors import APIError, BadArgument, InfinitodeError
 
 # local
 from exts.database import Database
 from common.custom import Context, LevelConverter
 from common.source import LeaderboardSource
 from common.pagination import LeaderboardPaginator
-from common.errors import BadChannel, InvalidDateError
+from common.errors import APITimeoutError, BadChannel, InvalidDateError
 from common.utils import (
     create_choices,
     round_to_nearest,
@@ -31,6 +34,20 @@ from common.utils import (
 if TYPE_CHECKING:
     from bot import Advinas
 
+# seconds between two prefetch requests
+PREFETCH_INTERVAL = 1.5
+# leaderboards are refetched once they are older than this
+PREFETCH_COLD_AGE = 15 * 60
+# or older than this, if their level was requested within the hot window
+PREFETCH_HOT_AGE = 60
+PREFETCH_HOT_WINDOW = 30 * 60
+# commands are served prefetched leaderboards up to this old, a full prefetch
+# cycle over all levels. The request makes the level hot, so later ones get
+# leaderboards at most PREFETCH_HOT_AGE old
+SERVE_MAX_AGE = PREFETCH_COLD_AGE
+# seconds a command waits for a live leaderboard before serving the last snapshot
+LIVE_FETCH_TIMEOUT = 5.0
+
 
 class Inf(commands.Cog):
     def __init__(self, bot: Advinas):
@@ -44,6 +61,120 @@ class Inf(commands.Cog):
         self.EMOJIS: dict[str, int] = inf["enemy_emojis"]
         self.ENDLESS: dict[bool, str] = {False: "NORMAL", True: "ENDLESS_I"}
 
+        # prefetched leaderboards as (level, mode, endless, beta): (fetched at, lb)
+        self.warm: dict[tuple[str, str, bool, bool], tuple[float, Leaderboard]] = {}
+        # when each key was last prefetched, successful or not
+        self.prefetched: dict[tuple[str, str, bool, bool], float] = {}
+        # when each level was last requested by a command
+        self.requested: dict[str, float] = {}
+        self.PREFETCH_KEYS = [
+            (level.upper() if level.startswith("dq") else level, mode, endless, beta)
+            for level in self.LEVELS
+            if (level.upper() if level.startswith("dq") else level) in SUPPORTED_MAPS
+            for mode in ("score", "waves")
+            for endless in (False, True)
+            for beta in (False, True)
+        ]
+        bot.loop.create_task(self.ready())
+
+    async def ready(self):
+        await self.bot.wait_until_ready()
+        self.prefetch_leaderboards.start()
+
+    async def cog_unload(self) -> None:
+        self.prefetch_leaderboards.cancel()
+
+    async def _fetch_leaderboard(
+        self, level: str, mode: str, endless: bool, beta: bool
+    ) -> Leaderboard:
+        # fresh, so the recorded time is the age of the data and not of the
+        # session cache entry it may have come from
+        lb: Leaderboard = await self.bot.API.leaderboards(
+            level, mode=mode, difficulty=self.ENDLESS[endless], beta=beta, fresh=True
+        )
+        self.warm[level, mode, endless, beta] = time.monotonic(), lb
+        return lb
+
+    def warm_leaderboard(
+        self,
+        level: str,
+        mode: str,
+        endless: bool,
+        beta: bool,
+        max_age: float = PREFETCH_COLD_AGE,
+    ) -> Leaderboard | None:
+        """Returns the prefetched leaderboard if it is younger than max_age seconds."""
+        entry = self.warm.get((level, mode, endless, beta))
+        if entry is None or time.monotonic() - entry[0] >= max_age:
+            return None
+        return entry[1]
+
+    async def get_leaderboard(
+        self, level: str, mode: str, endless: bool, beta: bool
+    ) -> Leaderboard:
+        """Returns the leaderboard from the prefetched ones if it is recent enough.
+
+        Commands are never served anything older than SERVE_MAX_AGE, anything
+        older is fetched on demand instead.
+        """
+        self.requested[level] = time.monotonic()
+
+        lb = self.warm_leaderboard(level, mode, endless, beta, SERVE_MAX_AGE)
+        if lb is not None:
+            return lb
+        try:
+            return await asyncio.wait_for(
+                self._fetch_leaderboard(level, mode, endless, beta),
+                LIVE_FETCH_TIMEOUT,
+            )
+        except (APIError, asyncio.TimeoutError) as err:
+            # serve the last snapshot while the api is down or slow
+            db: Database | None = self.bot.get_cog("Database")  # type: ignore
+            lb = None
+            if db is not None and hasattr(db, "leaderboards"):
+                lb = await db.latest_snapshot(level, mode, self.ENDLESS[endless], beta)
+            if lb is not None:
+                return lb
+            if isinstance(err, asyncio.TimeoutError):
+                raise APITimeoutError from None
+            raise
+
+    def _next_prefetch(self) -> tuple[str, str, bool, bool] | None:
+        """Picks the most overdue leaderboard to prefetch.
+
+        Leaderboards of recently requested levels go stale sooner.
+        """
+        now = time.monotonic()
+        best, best_overdue = None, 0.0
+        for key in self.PREFETCH_KEYS:
+            requested = self.requested.get(key[0])
+            hot = requested is not None and now - requested < PREFETCH_HOT_WINDOW
+            max_age = PREFETCH_HOT_AGE if hot else PREFETCH_COLD_AGE
+            fetched = self.prefetched.get(key)
+            if fetched is None:
+                return key
+            overdue = now - fetched - max_age
+            if overdue > best_overdue:
+                best, best_overdue = key, overdue
+        return best
+
+    # one request per iteration keeps the upstream load at a fixed rate
+    @tasks.loop(seconds=PREFETCH_INTERVAL)
+    async def prefetch_leaderboards(self):
+        key = self._next_prefetch()
+        if key is None:
+            return
+
+        self.prefetched[key] = time.monotonic()
+        try:
+            await self._fetch_leaderboard(*key)
+        except InfinitodeError:
+            pass
+
+    @prefetch_leaderboards.error
+    async def prefetch_error(self, err: BaseException):
+        await self.bot.task_error(self.prefetch_leaderboards, err)
+
     def cog_check(self, ctx: Context) -> bool:
         if ctx.guild and ctx.guild.id == 590288287864848387:
             if ctx.channel.id not in self.bot.BOT_CHANNELS:
@@ -64,9 +195,7 @@ class Inf(commands.Cog):
         source = LeaderboardSource(
             title,
             ctx.author,
-            lambda beta, endless: self.bot.API.leaderboards(
-                level, difficulty=self.ENDLESS[endless], beta=beta
-            ),
+            lambda beta, endless: self.get_leaderboard(level, "score", endless, beta),
         )
 
         await LeaderboardPaginator.start_with_source(ctx, source)
@@ -85,9 +214,7 @@ class Inf(commands.Cog):
         source = LeaderboardSource(
             title,
             ctx.author,
-            lambda beta, endless: self.bot.API.leaderboards(
-                level, mode="waves", difficulty=self.ENDLESS[endless], beta=beta
-            ),
+            lambda beta, endless: self.get_leaderboard(level, "waves", endless, beta),
         )
 
         await LeaderboardPaginator.start_with_source(ctx, source)
@@ -260,6 +387,17 @@ class Inf(commands.Cog):
 
         await ctx.reply(embed=em)
 
+    @commands.command(name="apistats")
+    @commands.is_owner()
+    async def _apistats(self, ctx: Context):
+        em = discord.Embed(title="API Cache", colour=60415)
+        for name, cache in self.bot.API.caches.items():
+            stats = cache.stats()
+            stats["Coalesced"] = self.bot.API.coalesced[name]
+            value = "\n".join(f"{k}: {v}" for k, v in stats.items())
+            em.add_field(name=name, value=value)
+        await ctx.reply(embed=em)
+
     @score.autocomplete("level")
     @waves.autocomplete("level")
     @level.autocomplete("level")
@@ -2,36 +2,222 @@ from __future__ import annotations
 
 # std
 import io
-import json
+import logging
+import gzip
+import time
+import asyncio
+from tempfile import SpooledTemporaryFile
+from dataclasses import dataclass, field
 from typing import Any, TYPE_CHECKING
 
 # packages
+import orjson
 import discord
-from discord.ext import commands
+from lru import LRU
+from discord.ext import commands, tasks
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError, PyMongoError
 
 # local
+import config
+from exts.database import Database
 from common.custom import (
     Context,
 )
+from common.messages import SCHEMA_VERSION, compact_message, expand_message, user_docs
+from common.utils import RateLimiter, fan_out
+
+log = logging.getLogger(__name__)
 
 if TYPE_CHECKING:
     from bot import Advinas
 
+# messages written to the database at once while ingesting a channel
+INGEST_BATCH_SIZE = 500
+# mongodb's error code for a duplicate key
+DUPLICATE_KEY = 11000
+# messages per history request
+HISTORY_PAGE = 100
+# seconds between two progress updates of a crawl
+PROGRESS_INTERVAL = 10
+# live messages are written once this many are buffered, or every flush interval
+LIVE_BATCH_SIZE = 100
+# messages buffered at most, new messages are dropped while it is full
+LIVE_BUFFER_SIZE = 5000
+# exports stay in memory up to this size, larger ones are moved to disk
+EXPORT_SPOOL_SIZE = 8 * 2**20
+# users whose last written document is remembered, to skip rewriting it
+KNOWN_USERS_SIZE = 50_000
+
+
+@dataclass
+class CrawlProgress:
+    channels: int
+    done: int = 0
+    failed: int = 0
+    messages: int = 0
+    started: float = field(default_factory=time.perf_counter)
+
+    def format(self) -> str:
+        elapsed = time.perf_counter() - self.started
+        return (
+            f"Channels: {self.done}/{self.channels} ({self.failed} failed)\n"
+            f"Messages: {self.messages} ({self.messages / elapsed:0.1f}/s)\n"
+            f"Elapsed: {elapsed:0.0f}s"
+        )
+
 
 class Stats(commands.Cog):
     def __init__(self, bot: Advinas) -> None:
         self.bot = bot
+        # live messages waiting to be written
+        self.buffer: list[dict[str, Any]] = []
+        self.dropped = 0
+        # the last written document of every user, and the ones still to write
+        self.known_users: LRU[int, dict[str, Any]] = LRU(KNOWN_USERS_SIZE)
+        self.pending_users: dict[int, dict[str, Any]] = {}
+        self.compress = getattr(config, "compress_message_content", False)
+        self.flush_lock = asyncio.Lock()
         bot.loop.create_task(self.ready())
 
     async def ready(self) -> None:
         await self.bot.wait_until_ready()
         self.col = self.bot.DB.messages
+        # one document per message, _id being the message id. See common.messages
+        self.messages = self.bot.DB.channelmessages
+        # the authors and mentioned users of those messages, _id being the user id
+        self.users = self.bot.DB.messageusers
+        # one document per channel with the id of the last ingested message
+        self.checkpoints = self.bot.DB.messagecheckpoints
+        self.flush_live_messages.start()
+
+    async def cog_unload(self) -> None:
+        self.flush_live_messages.cancel()
+        await self._flush_buffer()
+
+    async def _insert_messages(self, docs: list[dict[str, Any]]) -> int:
+        """Inserts the messages not stored yet, returns how many were inserted."""
+        try:
+            await self.messages.insert_many(docs, ordered=False)
+            inserted = len(docs)
+        except BulkWriteError as err:
+            # messages written before a crash are ingested again on resume
+            errors = err.details.get("writeErrors", [])
+            if any(error["code"] != DUPLICATE_KEY for error in errors):
+                raise
+            inserted = err.details.get("nInserted", len(docs) - len(errors))
+        await self._flush_users()
+        return inserted
+
+    async def _flush_users(self) -> None:
+        pending, self.pending_users = self.pending_users, {}
+        await Database.upsert(
+            self.users,
+            [{"_id": user_id} for user_id in pending],
+            list(pending.values()),
+        )
+        self.known_users.update(pending)
+
+    def _compact(self, parsed: dict[str, Any], channel_id: int) -> dict[str, Any]:
+        for user_id, user in user_docs(parsed).items():
+            if self.known_users.get(user_id) != user:
+                self.pending_users[user_id] = user
+        return compact_message(parsed, channel_id, compress=self.compress)
+
+    def _message_doc(self, message: discord.Message) -> dict[str, Any]:
+        return self._compact(self._parse_message(message), message.channel.id)
+
+    async def ingest_channel(
+        self,
+        channel: discord.TextChannel,
+        *,
+        batch_size: int = INGEST_BATCH_SIZE,
+        limiter: RateLimiter | None = None,
+        progress: CrawlProgress | None = None,
+    ) -> int:
+        """Writes the messages of the channel written since the last checkpoint.
 
-    async def _add_channel(self, data: dict[str, Any]) -> None:
-        await self.col.insert_one(data)
+        Messages are written in batches as the history pages arrive, the
+        checkpoint is moved forward after every batch. Every history request
+        takes a token from ``limiter``. Returns the amount of messages stored.
+        """
+        checkpoint = await self.checkpoints.find_one({"_id": channel.id})
+        after = discord.Object(checkpoint["last"]) if checkpoint else None
 
-    async def _add_message(self, channel_id: int, data: dict[str, Any]) -> None:
-        await self.col.update_one({"_id": channel_id}, {"$push": {"messages": data}})
+        count = seen = 0
+        batch: list[dict[str, Any]] = []
+        history = channel.history(limit=None, oldest_first=True, after=after)
+        while True:
+            # every HISTORY_PAGE messages the next one comes with a new request
+            if limiter is not None and seen % HISTORY_PAGE == 0:
+                await limiter.acquire()
+            try:
+                message = await anext(history)
+            except StopAsyncIteration:
+                break
+            seen += 1
+            batch.append(self._message_doc(message))
+            if len(batch) >= batch_size:
+                inserted = await self._checkpoint(channel, batch)
+                count += inserted
+                if progress is not None:
+                    progress.messages += inserted
+                batch = []
+
+        if batch:
+            inserted = await self._checkpoint(channel, batch)
+            count += inserted
+            if progress is not None:
+                progress.messages += inserted
+        return count
+
+    async def crawl(
+        self,
+        channels: list[discord.TextChannel],
+        progress: CrawlProgress,
+        *,
+        concurrency: int = 4,
+        rate: float = 20,
+    ) -> None:
+        """Ingests the channels concurrently, sharing one request budget.
+
+        Every channel resumes from its checkpoint, so an interrupted crawl
+        continues where it stopped when started again.
+        """
+        limiter = RateLimiter(rate, burst=concurrency)
+
+        async def crawl_channel(channel: discord.TextChannel) -> None:
+            try:
+                count = await self.ingest_channel(
+                    channel, limiter=limiter, progress=progress
+                )
+            except discord.HTTPException as err:
+                progress.failed += 1
+                log.warning("Could not crawl channel %s: %s", channel.name, err)
+            else:
+                log.info("Crawled %d messages of channel %s", count, channel.name)
+            progress.done += 1
+
+        await fan_out(*map(crawl_channel, channels), limit=concurrency, timeout=None)
+
+    async def _checkpoint(
+        self, channel: discord.TextChannel, batch: list[dict[str, Any]]
+    ) -> int:
+        # messages already stored before a resume aren't counted again
+        inserted = await self._insert_messages(batch)
+        await self.checkpoints.update_one(
+            {"_id": channel.id},
+            {
+                "$set": {
+                    "last": batch[-1]["_id"],
+                    "name": channel.name,
+                    "category": channel.category.name if channel.category else None,
+                },
+                "$inc": {"messages_count": inserted},
+            },
+            upsert=True,
+        )
+        return inserted
 
     def _parse_message(
         self, message: discord.Message, *, dt_obj: bool = True
@@ -121,64 +307,205 @@ class Stats(commands.Cog):
         }
         return data
 
-    async def _fetch_messages(
-        self, channel: discord.TextChannel, *, dt_obj: bool = True
-    ) -> dict[str, Any]:
-        count, channel_id = 0, channel.id
-        messages: list[dict[str, Any]] = []
-        async for message in channel.history(limit=None, oldest_first=True):
-            messages.append(self._parse_message(message, dt_obj=dt_obj))
-            count += 1
-            if count % 1e3 == 0:
-                print(channel_id, f"{count=}")
-        data = {
-            "_id": channel_id,
-            "category": channel.category.name if channel.category else None,
-            "messages": messages,
-            "messages_count": len(messages),
-            "name": channel.name,
-        }
-        return data
+    async def _export_messages(
+        self, channel: discord.TextChannel, fp: SpooledTemporaryFile[bytes]
+    ) -> int:
+        """Writes the history of the channel to fp as gzipped newline delimited JSON.
+
+        The first line describes the channel, every other line is one message.
+        Returns the amount of messages written.
+        """
+        count = 0
+        with gzip.GzipFile(fileobj=fp, mode="wb") as gz:
+            channel_info = {
+                "_id": channel.id,
+                "category": channel.category.name if channel.category else None,
+                "name": channel.name,
+            }
+            gz.write(orjson.dumps(channel_info, option=orjson.OPT_APPEND_NEWLINE))
+            async for message in channel.history(limit=None, oldest_first=True):
+                data = self._parse_message(message)
+                gz.write(orjson.dumps(data, option=orjson.OPT_APPEND_NEWLINE))
+                count += 1
+        return count
+
+    async def _export_stored(
+        self, channel: discord.TextChannel, fp: SpooledTemporaryFile[bytes]
+    ) -> int:
+        """Like _export_messages, but reads the stored messages of the channel."""
+        count = 0
+        with gzip.GzipFile(fileobj=fp, mode="wb") as gz:
+            channel_info = {
+                "_id": channel.id,
+                "category": channel.category.name if channel.category else None,
+                "name": channel.name,
+            }
+            gz.write(orjson.dumps(channel_info, option=orjson.OPT_APPEND_NEWLINE))
+            cursor = self.messages.find(
+                {"c": channel.id, "v": SCHEMA_VERSION}, sort=[("_id", 1)]
+            )
+            async for doc in cursor:
+                data = expand_message(doc)
+                gz.write(orjson.dumps(data, option=orjson.OPT_APPEND_NEWLINE))
+                count += 1
+        return count
+
+    async def _flush_buffer(self) -> None:
+        if not self.buffer or not hasattr(self, "messages"):
+            return
+
+        async with self.flush_lock:
+            batch, self.buffer = self.buffer, []
+            try:
+                await self._insert_messages(batch)
+            except PyMongoError:
+                # retried with the next flush, as far as the buffer has room
+                room = LIVE_BUFFER_SIZE - len(self.buffer)
+                self.dropped += max(len(batch) - room, 0)
+                self.buffer[:0] = batch[:room]
+                raise
+
+    @tasks.loop(seconds=30)
+    async def flush_live_messages(self):
+        try:
+            await self._flush_buffer()
+        except PyMongoError:
+            pass
+
+    @flush_live_messages.error
+    async def flush_error(self, err: BaseException):
+        await self.bot.task_error(self.flush_live_messages, err)
+
+    @commands.Cog.listener("on_message")
+    async def _message_listener(self, message: discord.Message) -> None:
+        if not (message.guild and message.guild.id == 590288287864848387):
+            return
+
+        if len(self.buffer) >= LIVE_BUFFER_SIZE:
+            # the database can't keep up, dropping is better than growing forever
+            self.dropped += 1
+            return
+
+        self.buffer.append(self._message_doc(message))
+        if len(self.buffer) >= LIVE_BATCH_SIZE and not self.flush_lock.locked():
+            try:
+                await self._flush_buffer()
+            except PyMongoError:
+                pass
+
+    async def upgrade_messages(
+        self, batch_size: int = INGEST_BATCH_SIZE
+    ) -> tuple[int, int]:
+        """Converts stored messages into the current compact schema.
 
-    # @commands.Cog.listener('on_message')
-    # async def _message_listener(self, message: discord.Message) -> None:
-    #     if not (message.guild and message.guild.id == 590288287864848387):
-    #         return
+        Covers version 1 documents of channelmessages and the old per
+        channel documents of messages, which are left in place. Returns the
+        amount of documents upgraded and copied.
+        """
+        upgraded = 0
+        batch: list[ReplaceOne[dict[str, Any]]] = []
+        cursor = self.messages.find({"v": {"$exists": False}})
+        async for doc in cursor:
+            doc["id"] = doc.pop("_id")
+            compact = self._compact(doc, doc["channel"])
+            batch.append(ReplaceOne({"_id": doc["id"]}, compact))
+            if len(batch) >= batch_size:
+                await self.messages.bulk_write(batch, ordered=False)
+                upgraded += len(batch)
+                batch = []
+        if batch:
+            await self.messages.bulk_write(batch, ordered=False)
+            upgraded += len(batch)
 
-    #     data = self._parse_message(message)
-    #     await self._add_message(message.channel.id, data)
+        copied = 0
+        # one channel at a time, each document holds all of its messages
+        async for channel in self.col.find({}, {"_id": 1}):
+            doc = await self.col.find_one({"_id": channel["_id"]})
+            if doc is None:
+                continue
+            messages = [self._compact(m, doc["_id"]) for m in doc["messages"]]
+            for index in range(0, len(messages), batch_size):
+                await self._insert_messages(messages[index : index + batch_size])
+            copied += len(messages)
+
+        await self._flush_users()
+        return upgraded, copied
+
+    @commands.command(name="upgrademessages")
+    @commands.is_owner()
+    async def _upgrademessages(self, ctx: Context) -> None:
+        async with ctx.typing():
+            upgraded, copied = await self.upgrade_messages()
+        await ctx.reply(
+            f"Upgraded {upgraded} and copied {copied} messages "
+            f"to schema version {SCHEMA_VERSION}."
+        )
+
+    @commands.command(name="livestats")
+    @commands.is_owner()
+    async def _livestats(self, ctx: Context) -> None:
+        await ctx.reply(
+            f"Buffered: {len(self.buffer)}/{LIVE_BUFFER_SIZE}\nDropped: {self.dropped}"
+        )
 
     @commands.command(name="history")
     @commands.is_owner()
-    async def history(self, ctx: Context, channel: discord.TextChannel) -> None:
+    async def history(
+        self, ctx: Context, channel: discord.TextChannel, stored: bool = False
+    ) -> None:
+        limit = (
+            ctx.guild.filesize_limit
+            if ctx.guild
+            else discord.utils.DEFAULT_FILE_SIZE_LIMIT_BYTES
+        )
         async with ctx.typing():
-            data = await self._fetch_messages(channel, dt_obj=False)
-            buffer = io.StringIO()
-            json.dump(data, buffer)
-            buffer.seek(0)
-            file = discord.File(filename=f"{channel.id}.json", fp=buffer)  # type: ignore # nopep8
-            await ctx.send(file=file)
+            with SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE) as fp:
+                if stored:
+                    count = await self._export_stored(channel, fp)
+                else:
+                    count = await self._export_messages(channel, fp)
+                size = fp.tell()
+                fp.seek(0)
+
+                # one part per message, so only one part is in memory at a time.
+                # The parts have to be joined again before unzipping
+                parts = -(-size // limit)
+                filename = f"{channel.id}.ndjson.gz"
+                for part in range(1, parts + 1):
+                    name = filename if parts == 1 else f"{filename}.{part:03}"
+                    file = discord.File(io.BytesIO(fp.read(limit)), filename=name)
+                    await ctx.send(file=file)
+
+        await ctx.reply(f"Exported {count} messages in {parts} part(s).")
 
     @commands.command(name="fetchall")
     @commands.is_owner()
     async def _fetch_all(self, ctx: Context) -> None:
         guild = ctx.bot.get_guild(590288287864848387)
         assert guild
-        async with ctx.typing():
-            chs = guild.text_channels[34:]
-            chs.pop(-4)
-            for channel in chs:
-                data = await self._fetch_messages(channel, dt_obj=False)
-                with open(
-                    f"data/messages/{channel.id}.json", "w", encoding="utf-8"
-                ) as f:
-                    json.dump(data, f, indent=4)
-                try:
-                    await self._add_channel(data)
-                except Exception:
-                    await ctx.reply(f"couldnt upload {channel.id}")
-                await ctx.reply(f"Finished channel `{channel.name}`")
-            await ctx.reply("Done")
+        chs = guild.text_channels[34:]
+        chs.pop(-4)
+        channels = [
+            channel
+            for channel in chs
+            if channel.permissions_for(guild.me).read_message_history
+        ]
+        progress = CrawlProgress(len(channels))
+        message = await ctx.reply(progress.format())
+
+        crawl = asyncio.create_task(
+            self.crawl(
+                channels,
+                progress,
+                concurrency=getattr(config, "crawl_concurrency", 4),
+                rate=getattr(config, "crawl_rate", 20),
+            )
+        )
+        while not crawl.done():
+            await asyncio.wait({crawl}, timeout=PROGRESS_INTERVAL)
+            await message.edit(content=progress.format())
+        crawl.result()
+        await ctx.reply("Done")
 
 
 async def setup(bot: Advinas):
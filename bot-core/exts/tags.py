@@ -1,19 +1,26 @@
 from __future__ import annotations
 
 # std
+import logging
 from typing import Annotated, Any, Literal, overload
 
 # packages
 import discord
+from bson import ObjectId
 from discord import Interaction, app_commands
-from discord.ext import commands
+from discord.ext import commands, tasks
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
+from lru import LRU
 
 # local
+import config
 from bot import Advinas
+from exts.database import Database
 from common.source import TagSource
 from common.pagination import TagPaginator
 from common.errors import TagError
-from common.utils import create_choices
+from common.search import TrigramIndex
 from common.custom import (
     Context,
     GuildContext,
@@ -22,17 +29,86 @@ from common.custom import (
     TagName,
 )
 
+log = logging.getLogger(__name__)
+
+# ids of the last use flushes every tag remembers, see Tags._write_uses
+FLUSH_IDS_KEPT = 10
+
 
 class Tags(commands.Cog):
     def __init__(self, bot: Advinas):
         self.bot = bot
-        self.cache: dict[int, dict[str, Tag | TagAlias]] = {}
+        # the tags of the most recently used guilds, without their content
+        self.cache: LRU[int, dict[str, Tag | TagAlias]] = LRU(
+            getattr(config, "tag_cache_guilds", 256)
+        )
+        self.cache.set_callback(self._evicted)
+        # fuzzy search over the tag names of cached guilds, built once needed
+        self.name_indexes: dict[int, TrigramIndex] = {}
+        # the tag version of every cached guild. Every write except uses
+        # increments it, so edits made outside of this cog can be detected
+        self.versions: dict[int, int] = {}
+        # uses not written yet, keyed by (guild id, tag name)
+        self.pending_uses: dict[tuple[int, str], int] = {}
+        # a flush that may have been applied partially, retried with its id
+        self.unflushed: tuple[ObjectId, dict[tuple[int, str], int]] | None = None
+        # tags whose uses failed to be written once, dropped when failing again
+        self.failed_uses: set[tuple[int, str]] = set()
+        # whether the last flush failed, so an outage is only reported once
+        self.flush_failed = False
         bot.loop.create_task(self.ready())
 
     async def ready(self):
         await self.bot.wait_until_ready()
-        self.col = self.bot.DB.tags
-        await self.cache_tags()
+        self.col = self.bot.DB.guildtags
+        self.tag_versions = self.bot.DB.tagversions
+        if await self.col.estimated_document_count() == 0:
+            await self.migrate_tags()
+        self.check_tag_versions.start()
+        self.flush_tag_uses.start()
+
+    async def cog_unload(self) -> None:
+        self.check_tag_versions.cancel()
+        self.flush_tag_uses.cancel()
+        # also called when the bot closes
+        await self._flush_uses()
+
+    async def _modified(self, guild_id: int) -> None:
+        await self.tag_versions.update_one(
+            {"guild": guild_id}, {"$inc": {"version": 1}}, upsert=True
+        )
+        # a write of ours, an external write in between results in a reload.
+        # Uncached guilds read their version once they are loaded
+        if guild_id in self.versions:
+            self.versions[guild_id] += 1
+
+    async def migrate_tags(self) -> tuple[int, int]:
+        """Copies the tags of the old per guild documents into one document per tag.
+
+        Guilds are marked as migrated in tagversions and skipped afterwards,
+        so tags deleted since aren't brought back. Existing tags are never
+        overwritten. Returns the amount of guilds and tags migrated.
+        """
+        migrated = set(await self.tag_versions.distinct("guild", {"migrated": True}))
+        guilds: list[int] = []
+        filters: list[dict[str, Any]] = []
+        docs: list[dict[str, Any]] = []
+        async for doc in self.bot.DB.tags.find({}, {"_id": 0, "guild": 1, "tags": 1}):
+            if doc["guild"] in migrated:
+                continue
+            guilds.append(doc["guild"])
+            for t in doc["tags"]:
+                filters.append({"guild": doc["guild"], "name": t["name"]})
+                docs.append({**t, "guild": doc["guild"]})
+
+        await Database.upsert(self.col, filters, docs, insert_only=True)
+        for guild_id in guilds:
+            await self.tag_versions.update_one(
+                {"guild": guild_id},
+                {"$set": {"migrated": True}, "$inc": {"version": 1}},
+                upsert=True,
+            )
+        return len(guilds), len(docs)
 
     def cog_check(self, ctx: Context) -> bool:
         if ctx.guild is None:
@@ -40,93 +116,217 @@ class Tags(commands.Cog):
         return True
 
     async def _fetch_tag(self, guild_id: int, name: str) -> dict[str, Any] | None:
-        ret: dict[str, Any] | None = await self.col.find_one(
-            {"guild": guild_id, "tags.name": name.lower()},
-            {"_id": 0, "guild": 1, "tags.$": 1},
+        return await self.col.find_one(
+            {"guild": guild_id, "name": name.lower()}, {"_id": 0, "flushes": 0}
         )
-        if ret is None:
-            if await self.col.find_one({"guild": guild_id}) is None:
-                await self.col.insert_one({"guild": guild_id, "tags": []})
-        return ret
+
+    async def _insert_tag(self, doc: dict[str, Any]) -> None:
+        try:
+            await self.col.insert_one(doc)
+        except DuplicateKeyError:
+            raise TagError(f'A tag with the name "{doc["name"]}" already exists.')
 
     async def _create_tag(self, ctx: GuildContext, name: str, content: str) -> None:
-        await self.col.update_one(
-            {"guild": ctx.guild.id},
+        tag = Tag(
+            name.lower(),
+            content,
+            ctx.guild.id,
+            0,
+            ctx.author.id,
+            ctx.message.created_at,
+        )
+        await self._insert_tag(
             {
-                "$push": {
-                    "tags": {
-                        "name": name.lower(),
-                        "content": content,
-                        "uses": 0,
-                        "owner_id": ctx.author.id,
-                        "created_at": ctx.message.created_at,
-                    }
-                }
-            },
+                "guild": tag.guild_id,
+                "name": tag.name,
+                "content": tag.content,
+                "uses": tag.uses,
+                "owner_id": tag.owner_id,
+                "created_at": tag.created_at,
+            }
         )
+        (await self.guild_tags(ctx.guild.id))[tag.name] = tag
+        if (index := self.name_indexes.get(ctx.guild.id)) is not None:
+            index.add(tag.name)
+        await self._modified(ctx.guild.id)
 
     async def _create_alias(
         self, ctx: GuildContext, new_name: str, old_name: str
     ) -> None:
-        await self.col.update_one(
-            {"guild": ctx.guild.id},
+        alias = TagAlias(
+            new_name.lower(),
+            old_name.lower(),
+            ctx.guild.id,
+            ctx.author.id,
+            ctx.message.created_at,
+        )
+        await self._insert_tag(
             {
-                "$push": {
-                    "tags": {
-                        "name": new_name.lower(),
-                        "alias": old_name.lower(),
-                        "owner_id": ctx.author.id,
-                        "created_at": ctx.message.created_at,
-                    }
-                }
-            },
+                "guild": alias.guild_id,
+                "name": alias.name,
+                "alias": alias.alias,
+                "owner_id": alias.owner_id,
+                "created_at": alias.created_at,
+            }
         )
+        (await self.guild_tags(ctx.guild.id))[alias.name] = alias
+        if (index := self.name_indexes.get(ctx.guild.id)) is not None:
+            index.add(alias.name)
+        await self._modified(ctx.guild.id)
 
     async def used_tag(self, tag: Tag) -> None:
-        await self.col.update_one(
-            {"guild": tag.guild_id, "tags.name": tag.name}, {"$inc": {"tags.$.uses": 1}}
-        )
+        # written in bulk by flush_tag_uses
+        key = (tag.guild_id, tag.name)
+        self.pending_uses[key] = self.pending_uses.get(key, 0) + 1
+        tag.uses += 1
+
+    async def _flush_uses(self) -> None:
+        if not hasattr(self, "col"):
+            return
+
+        if self.unflushed is not None:
+            flush_id, pending = self.unflushed
+            self.unflushed = None
+            if not await self._write_uses(flush_id, pending):
+                return
+        if self.pending_uses:
+            pending, self.pending_uses = self.pending_uses, {}
+            await self._write_uses(ObjectId(), pending)
+
+    async def _write_uses(
+        self, flush_id: ObjectId, pending: dict[tuple[int, str], int]
+    ) -> bool:
+        """Adds the uses to the tags, returns whether the database was reachable.
+
+        Every tag remembers the ids of its last FLUSH_IDS_KEPT flushes, so a
+        flush written again with the same id skips the tags it already counted.
+        """
+        keys = list(pending)
+        try:
+            await self.col.bulk_write(
+                [
+                    UpdateOne(
+                        {"guild": guild_id, "name": name, "flushes": {"$ne": flush_id}},
+                        {
+                            "$inc": {"uses": uses},
+                            "$push": {
+                                "flushes": {
+                                    "$each": [flush_id],
+                                    "$slice": -FLUSH_IDS_KEPT,
+                                }
+                            },
+                        },
+                    )
+                    for (guild_id, name), uses in pending.items()
+                ],
+                ordered=False,
+            )
+        except BulkWriteError as err:
+            # the other operations were applied, only the failed ones are retried
+            failed = [keys[error["index"]] for error in err.details["writeErrors"]]
+            dropped = [key for key in failed if key in self.failed_uses]
+            self.failed_uses.difference_update(pending)
+            for key in failed:
+                if key not in dropped:
+                    uses = self.pending_uses.get(key, 0) + pending[key]
+                    self.pending_uses[key] = uses
+                    self.failed_uses.add(key)
+            if dropped:
+                log.warning(
+                    "Dropped the uses of %d tags failing twice: %s",
+                    len(dropped),
+                    ", ".join(f"{guild_id}/{name}" for guild_id, name in dropped),
+                )
+                await self.bot.task_error(self.flush_tag_uses, err)
+        except PyMongoError as err:
+            # most likely the connection, it's unknown which tags were counted
+            self.unflushed = (flush_id, pending)
+            if not self.flush_failed:
+                await self.bot.task_error(self.flush_tag_uses, err)
+            self.flush_failed = True
+            return False
+        else:
+            self.failed_uses.difference_update(pending)
+        self.flush_failed = False
+        return True
+
+    @tasks.loop(seconds=60)
+    async def flush_tag_uses(self):
+        await self._flush_uses()
+
+    @flush_tag_uses.error
+    async def flush_error(self, err: BaseException):
+        await self.bot.task_error(self.flush_tag_uses, err)
 
     async def delete_tag(self, tag: Tag | TagAlias) -> None:
-        await self.col.update_one(
-            {"guild": tag.guild_id}, {"$pull": {"tags": {"name": tag.name}}}
-        )
+        await self.col.delete_one({"guild": tag.guild_id, "name": tag.name})
+        self.cache.get(tag.guild_id, {}).pop(tag.name, None)
+        if (index := self.name_indexes.get(tag.guild_id)) is not None:
+            index.discard(tag.name)
+        await self._modified(tag.guild_id)
 
     async def edit_tag(self, tag: Tag, content: str) -> None:
         await self.col.update_one(
-            {"guild": tag.guild_id, "tags.name": tag.name},
-            {"$set": {"tags.$.content": content}},
+            {"guild": tag.guild_id, "name": tag.name}, {"$set": {"content": content}}
         )
+        tag.content = content
+        await self._modified(tag.guild_id)
 
     async def transfer_tag(self, tag: Tag | TagAlias, owner_id: int) -> None:
         await self.col.update_one(
-            {"guild": tag.guild_id, "tags.name": tag.name},
-            {"$set": {"tags.$.owner_id": owner_id}},
+            {"guild": tag.guild_id, "name": tag.name}, {"$set": {"owner_id": owner_id}}
         )
+        tag.owner_id = owner_id
+        await self._modified(tag.guild_id)
 
-    def get_tag_list(
+    async def get_tag_list(
         self, guild_id: int, member_id: int | None
     ) -> list[Tag | TagAlias]:
+        tags = await self.guild_tags(guild_id)
         if member_id is not None:
-            tag_list = [
-                tag
-                for tag in self.cache.get(guild_id, {}).values()
-                if tag.owner_id == member_id
-            ]
+            tag_list = [tag for tag in tags.values() if tag.owner_id == member_id]
         else:
-            tag_list = list(self.cache.get(guild_id, {}).values())
+            tag_list = list(tags.values())
         if not tag_list:
             location = "for that user" if member_id else "in that guild"
             raise TagError(f"No tags found {location}.")
         return sorted(tag_list, key=lambda t: t.name)
 
+    async def guild_tags(self, guild_id: int) -> dict[str, Tag | TagAlias]:
+        """Returns the tags of the guild, loading them if they aren't cached."""
+        tags = self.cache.get(guild_id)
+        if tags is None:
+            tags = await self._cache_guild(guild_id)
+        return tags
+
+    async def name_index(self, guild_id: int) -> TrigramIndex:
+        tags = await self.guild_tags(guild_id)
+        index = self.name_indexes.get(guild_id)
+        if index is None:
+            index = self.name_indexes[guild_id] = TrigramIndex(tags)
+        return index
+
+    def _evicted(self, guild_id: int, _: dict[str, Tag | TagAlias]) -> None:
+        self.name_indexes.pop(guild_id, None)
+        self.versions.pop(guild_id, None)
+
+    async def _not_found(self, guild_id: int, name: str) -> str:
+        index = await self.name_index(guild_id)
+        suggestions = index.search(name, 3, threshold=0.3)
+        if not suggestions:
+            return "Tag not found."
+        return f"Tag not found. Did you mean {', '.join(map(repr, suggestions))}?"
+
     async def _get_tag(self, guild_id: int, name: str) -> Tag | TagAlias | None:
-        if guild_id not in self.cache:
-            self.cache[guild_id] = {}
-            if await self.col.find_one({"guild": guild_id}) is None:
-                await self.col.insert_one({"guild": guild_id, "tags": []})
-            return None
-        return self.cache.get(guild_id, {}).get(name, None)
+        return (await self.guild_tags(guild_id)).get(name, None)
+
+    async def _load_content(self, tag: Tag) -> None:
+        if tag.content is not None:
+            return
+        doc = await self.col.find_one(
+            {"guild": tag.guild_id, "name": tag.name}, {"_id": 0, "content": 1}
+        )
+        tag.content = doc["content"] if doc is not None else ""
 
     @overload
     async def get_tag(
@@ -158,17 +358,19 @@ class Tags(commands.Cog):
     ) -> Tag | TagAlias:
         tag: Tag | TagAlias | None = await self._get_tag(guild_id, name)
         if tag is None:
-            raise TagError("Tag not found.")
+            raise TagError(await self._not_found(guild_id, name))
         if isinstance(tag, TagAlias):
             main_tag = await self._get_tag(tag.guild_id, tag.alias)
             if main_tag is None or isinstance(main_tag, TagAlias):
                 await self.delete_tag(Tag.minimal(name, guild_id))
-                await self.cache_tags()
                 raise TagError("Tag not found.")
             if no_alias:
                 raise TagError("You may not edit an alias.")
             if not return_alias:
+                await self._load_content(main_tag)
                 return main_tag
+        else:
+            await self._load_content(tag)
         return tag
 
     async def create_tag(self, ctx: GuildContext, name: str, content: str) -> None:
@@ -203,18 +405,44 @@ class Tags(commands.Cog):
                     "This is not your tag and you do not have the `manage server` permission."
                 )
 
+    @staticmethod
+    def _from_doc(doc: dict[str, Any]) -> Tag | TagAlias:
+        return Tag.from_db(doc) if "alias" not in doc else TagAlias.from_db(doc)
+
+    async def _cache_guild(self, guild_id: int) -> dict[str, Tag | TagAlias]:
+        # read the version first, so a write while loading results in a reload
+        ver = await self.tag_versions.find_one({"guild": guild_id}, {"_id": 0})
+        version: int = ver["version"] if ver is not None else 0
+        tags = {
+            doc["name"]: self._from_doc(doc)
+            async for doc in self.col.find(
+                {"guild": guild_id}, {"_id": 0, "content": 0, "flushes": 0}
+            )
+        }
+        self.cache[guild_id] = tags
+        self.versions[guild_id] = version
+        self.name_indexes.pop(guild_id, None)
+        return tags
+
     async def cache_tags(self) -> None:
+        # guilds are loaded again once they are used
         self.cache.clear()
-        async for doc in self.col.find({}, {"_id": 0, "guild": 1, "tags": 1}):
-            tags = doc["tags"]
-            self.cache[doc["guild"]] = {
-                t["name"]: (
-                    Tag(**t, guild_id=doc["guild"])
-                    if "alias" not in t
-                    else TagAlias(**t, guild_id=doc["guild"])
-                )
-                for t in tags
-            }
+        self.versions.clear()
+        self.name_indexes.clear()
+
+    @tasks.loop(minutes=5)
+    async def check_tag_versions(self):
+        # only reloads the cached guilds whose tags were changed by someone else
+        guild_ids = list(self.cache.keys())
+        async for doc in self.tag_versions.find(
+            {"guild": {"$in": guild_ids}}, {"_id": 0}
+        ):
+            if self.versions.get(doc["guild"], 0) != doc["version"]:
+                await self._cache_guild(doc["guild"])
+
+    @check_tag_versions.error
+    async def task_error(self, err: BaseException):
+        await self.bot.task_error(self.check_tag_versions, err)
 
     @commands.command(name="cache")
     @commands.is_owner()
@@ -222,6 +450,13 @@ class Tags(commands.Cog):
         await self.cache_tags()
         await ctx.reply("Cache updated.")
 
+    @commands.command(name="migratetags")
+    @commands.is_owner()
+    async def _migratetags(self, ctx: GuildContext) -> None:
+        guilds, tags = await self.migrate_tags()
+        await self.cache_tags()
+        await ctx.reply(f"Migrated {tags} tags of {guilds} guilds.")
+
     @app_commands.command(
         name="t", description="Gets and shows the tag with the given name."
     )
@@ -298,7 +533,6 @@ class Tags(commands.Cog):
             return await ctx.send("Tag content is a maximum of 2000 characters.")
 
         await self.create_tag(ctx, name, content)
-        await self.cache_tags()
 
     @tag.command(
         name="alias", description="Creates an alias tag that points to another tag."
@@ -316,7 +550,6 @@ class Tags(commands.Cog):
         old_name: Annotated[str, TagName],
     ):
         await self.create_alias(ctx, new_name, old_name)
-        await self.cache_tags()
 
     @tag.command(
         name="edit", description="Edits an existing tag. Aliases may not be edited."
@@ -338,7 +571,6 @@ class Tags(commands.Cog):
 
         await self.edit_tag(tag, content)
         await ctx.reply(f'Tag "{name}" successfully edited.')
-        await self.cache_tags()
 
     @tag.command(
         name="remove",
@@ -353,7 +585,6 @@ class Tags(commands.Cog):
 
         await self.delete_tag(tag=tag)
         await ctx.reply(f'Tag "{name}" successfully deleted.')
-        await self.cache_tags()
 
     @tag.command(
         name="transfer", description="Transfers one of your tags to another member."
@@ -382,7 +613,6 @@ class Tags(commands.Cog):
         await ctx.reply(
             f"Successfully transferred tag `{discord.utils.escape_markdown(tag.name)}` to `{member.display_name}`."
         )
-        await self.cache_tags()
 
     @tag.command(
         name="info",
@@ -414,7 +644,7 @@ class Tags(commands.Cog):
     async def _raw(self, ctx: GuildContext, *, name: Annotated[str, TagName]):
         tag = await self.get_tag(ctx.guild.id, name)
 
-        escaped = discord.utils.escape_markdown(tag.content)
+        escaped = discord.utils.escape_markdown(tag.content or "")
         await ctx.safe_send(escaped.replace("<", "\\<"), reference=ctx.message)
 
     @t.autocomplete("name")
@@ -425,23 +655,25 @@ class Tags(commands.Cog):
     async def t_name_autocomplete(
         self, inter: Interaction, current: str
     ) -> list[app_commands.Choice[str]]:
-        lower = current.lower()
-        tags = self.cache.get(inter.guild.id, {}).keys()  # type: ignore
-        return create_choices({i for i in tags if lower in i})
+        index = await self.name_index(inter.guild.id)  # type: ignore
+        return [
+            app_commands.Choice(name=name, value=name) for name in index.search(current)
+        ]
 
     @_edit.autocomplete("name")
     @_remove.autocomplete("name")
     async def t_edit_autocomplete(
         self, inter: Interaction, current: str
     ) -> list[app_commands.Choice[str]]:
-        lower = current.lower()
-        return create_choices(
-            {
-                name
-                for name, tag in self.cache.get(inter.guild.id, {}).items()  # type: ignore # nopep8
-                if tag.owner_id == inter.user.id and lower in name
-            }
-        )
+        index = await self.name_index(inter.guild.id)  # type: ignore
+        tags = await self.guild_tags(inter.guild.id)  # type: ignore
+        # the guild may have been reloaded in between, so the two can differ
+        names = [
+            name
+            for name in index.search(current, None)
+            if (tag := tags.get(name)) is not None and tag.owner_id == inter.user.id
+        ]
+        return [app_commands.Choice(name=name, value=name) for name in names[:25]]
 
     @tag.command(
         name="list", description="Shows a list of tags available in this server."
@@ -451,7 +683,7 @@ class Tags(commands.Cog):
     async def _list(self, ctx: GuildContext, *, member: discord.Member | None = None):
         member_id = member.id if member is not None else None
         name = member.name if member is not None else ctx.guild.name
-        tag_list = self.get_tag_list(ctx.guild.id, member_id)
+        tag_list = await self.get_tag_list(ctx.guild.id, member_id)
 
         source = TagSource(tag_list, name, ctx.author)
         await TagPaginator.start_with_source(ctx, source)
@@ -0,0 +1,61 @@
+from __future__ import annotations
+
+# std
+import asyncio
+from types import SimpleNamespace
+from typing import Any
+
+# local
+from common.api import CachedSession
+
+
+class CountingSession(CachedSession):
+    calls = 0
+
+    async def player(  # type: ignore
+        self,
+        playerid: str | None = None,
+        nickname: str | None = None,
+        *,
+        beta: bool = False,
+    ) -> Any:
+        type(self).calls += 1
+        return SimpleNamespace(playerid=playerid, beta=beta, daily_quest=None)
+
+
+def test_same_key_positional_or_keyword() -> None:
+    async def main() -> None:
+        async with CountingSession() as api:
+            await api.player("U-1")
+            await api.player(playerid="U-1")
+            await api.player("U-1", beta=False)
+            assert CountingSession.calls == 1
+            await api.player("U-1", beta=True)
+            assert CountingSession.calls == 2
+
+    CountingSession.calls = 0
+    asyncio.run(main())
+
+
+def test_returns_copies() -> None:
+    async def main() -> None:
+        async with CountingSession() as api:
+            first = await api.player("U-2")
+            first.daily_quest = "mutated"
+            second = await api.player("U-2")
+            assert second.daily_quest is None
+            assert CountingSession.calls == 1
+
+    CountingSession.calls = 0
+    asyncio.run(main())
+
+
+def test_fresh_skips_cache() -> None:
+    async def main() -> None:
+        async with CountingSession() as api:
+            await api.player("U-3")
+            await api.player("U-3", fresh=True)
+            assert CountingSession.calls == 2
+
+    CountingSession.calls = 0
+    asyncio.run(main())
@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+# std
+import asyncio
+from types import SimpleNamespace
+from typing import Any
+
+# packages
+import pytest
+from infinitode import Leaderboard
+from infinitode.errors import InfinitodeError
+
+# local
+from exts import database
+from exts.database import Database
+
+
+def leaderboard(*scores: int) -> Leaderboard:
+    payload: dict[str, Any] = {
+        "player": {"total": len(scores)},
+        "leaderboards": [
+            {"playerid": f"U-{i}", "nickname": f"player{i}", "score": score}
+            for i, score in enumerate(scores)
+        ],
+    }
+    return Leaderboard.from_payload("", "", "", "", None, payload, date="2021-05-06")
+
+
+def cog(live: Leaderboard, beta: Leaderboard) -> Database:
+    async def daily_quest_leaderboards(
+        date: str | None = None, beta: bool = False
+    ) -> Leaderboard:
+        return boards[beta]
+
+    boards = {False: live, True: beta}
+    db = Database.__new__(Database)
+    db.bot = SimpleNamespace(  # type: ignore
+        API=SimpleNamespace(daily_quest_leaderboards=daily_quest_leaderboards)
+    )
+    return db
+
+
+@pytest.fixture(autouse=True)
+def no_delay(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(database, "BACKFILL_DELAY", 0)
+
+
+def test_fetch_dailyquest() -> None:
+    db = cog(leaderboard(300, 200), leaderboard(100))
+    doc = asyncio.run(db._fetch_dailyquest("2021-05-06"))
+
+    assert doc is not None
+    assert doc["date"] == "2021-05-06"
+    assert doc["live"]["total"] == 2
+    assert len(doc["live"]["leaderboards"]) == 2
+    assert len(doc["beta"]["leaderboards"]) == 1
+
+
+@pytest.mark.parametrize(
+    "live, beta",
+    [((), (100,)), ((300, 200), ()), ((), ())],
+)
+def test_fetch_dailyquest_empty(live: tuple[int, ...], beta: tuple[int, ...]) -> None:
+    # dates the api doesn't serve anymore are recorded as unavailable, not saved
+    db = cog(leaderboard(*live), leaderboard(*beta))
+    assert asyncio.run(db._fetch_dailyquest("2021-05-06")) is None
+
+
+def test_backfill_day_failed() -> None:
+    async def daily_quest_leaderboards(
+        date: str | None = None, beta: bool = False
+    ) -> Leaderboard:
+        raise InfinitodeError("unavailable")
+
+    db = Database.__new__(Database)
+    db.bot = SimpleNamespace(  # type: ignore
+        API=SimpleNamespace(daily_quest_leaderboards=daily_quest_leaderboards)
+    )
+    # failed requests are retried, unlike empty leaderboards
+    assert asyncio.run(db._backfill_day("2021-05-06")) is None
+
+    db = cog(leaderboard(), leaderboard())
+    assert asyncio.run(db._backfill_day("2021-05-06")) == ("2021-05-06", None)
@@ -0,0 +1,61 @@
+from __future__ import annotations
+
+# std
+from datetime import datetime
+from typing import Any
+
+# packages
+import pytest
+
+# local
+from common.messages import compact_message, expand_message, message_content
+
+
+def parsed(content: str) -> dict[str, Any]:
+    user = {"id": 1, "name": "user", "discriminator": "0", "bot": False}
+    return {
+        "id": 10,
+        "author": {**user, "system": False},
+        "mentions": [],
+        "created_at": datetime(2024, 1, 1),
+        "edited_at": None,
+        "content": content,
+        "bot": False,
+        "activity": False,
+        "mention_everyone": False,
+        "pinned": True,
+        "reference": False,
+        "system": False,
+        "system_content": content,
+        "webhook": False,
+        "attachments_count": 0,
+        "components_count": 0,
+        "embeds_count": 0,
+        "raw_mentions": [],
+        "raw_channel_mentions": [],
+        "raw_role_mentions": [],
+        "reactions": [{"name": "👍", "count": 2}],
+        "stickers": [],
+    }
+
+
+def test_compact_message_round_trip() -> None:
+    doc = compact_message(parsed("hello"), 5)
+    assert doc["m"] == "hello"
+
+    expanded = expand_message(doc)
+    assert expanded["channel"] == 5
+    assert expanded["content"] == "hello"
+    assert expanded["pinned"] and not expanded["bot"]
+    assert expanded["reactions"] == [{"name": "👍", "count": 2}]
+
+
+def test_compact_message_compressed() -> None:
+    pytest.importorskip("zstandard")
+    content = "compressible " * 20
+    doc = compact_message(parsed(content), 5, compress=True)
+    assert "m" not in doc
+    assert message_content(doc) == content
+
+    # short content is stored as is
+    assert compact_message(parsed("short"), 5, compress=True)["m"] == "short"
@@ -0,0 +1,82 @@
+from __future__ import annotations
+
+# packages
+import pytest
+
+# local
+from common.search import PrefixIndex, TrigramIndex, _edit_distance, search_all
+
+TAGS = ["help", "faq", "rules", "roles", "invite", "python", "pip", "hello"]
+
+
+def test_prefix_index_prefix_first() -> None:
+    index = PrefixIndex(["U-ABC", "abcdef", "xabc", "ab"])
+    assert index.search("ab") == ["ab", "abcdef", "U-ABC", "xabc"]
+
+
+def test_prefix_index_add_discard() -> None:
+    index = PrefixIndex(["alpha"])
+    index.add("Beta")
+    assert index.search("bet") == ["Beta"]
+    index.discard("beta")
+    assert index.search("bet") == []
+    assert len(index) == 1
+
+
+def test_prefix_index_batched_rebuild() -> None:
+    index = PrefixIndex(["xaby", "zab"], rebuild_after=2)
+    assert index.search("ab") == ["xaby", "zab"]
+    # changes since the buffer was built are searched without rebuilding it
+    index.add("cab")
+    index.discard("zab")
+    assert index.search("ab") == ["cab", "xaby"]
+    index.add("zab")
+    index.add("dab")
+    assert index.search("ab") == ["cab", "dab", "xaby", "zab"]
+
+
+def test_search_all_namespaces() -> None:
+    playerids = PrefixIndex(["U-AB"])
+    nicknames = PrefixIndex(["u-ab", "abc"])
+    # a nickname equal to a playerid is discarded from its own index only
+    nicknames.discard("u-ab")
+    assert search_all([playerids, nicknames], "ab") == ["abc", "U-AB"]
+    assert search_all([playerids, nicknames], "u-") == ["U-AB"]
+
+
+@pytest.mark.parametrize(
+    "a, b, distance",
+    [("hlep", "help", 1), ("fqa", "faq", 1), ("abc", "abc", 0), ("ab", "abcd", 2)],
+)
+def test_edit_distance(a: str, b: str, distance: int) -> None:
+    assert _edit_distance(a, b, 2) == distance
+
+
+def test_edit_distance_bound() -> None:
+    assert _edit_distance("kitten", "sitting", 1) == 2
+
+
+def test_trigram_index_prefix_first() -> None:
+    index = TrigramIndex(TAGS)
+    assert index.search("he", 2) == ["help", "hello"]
+
+
+@pytest.mark.parametrize(
+    "query, expected",
+    [("rlues", "rules"), ("hlep", "help"), ("fqa", "faq"), ("pyhton", "python")],
+)
+def test_trigram_index_typos(query: str, expected: str) -> None:
+    index = TrigramIndex(TAGS)
+    assert index.search(query, 3, threshold=0.3)[0] == expected
+
+
+def test_trigram_index_threshold() -> None:
+    index = TrigramIndex(TAGS)
+    assert index.search("xyz", 3, threshold=0.3) == []
+
+
+def test_trigram_index_discard() -> None:
+    index = TrigramIndex(TAGS)
+    index.discard("Help")
+    assert "help" not in index
+    assert "help" not in index.search("hlep", None)